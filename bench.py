@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+    bench
+    ~~~~~
+
+    Benchmarks for Flask-Sendmail: building, checking and serializing
+    messages, and delivering them to fake_sendmail.py so no mail server is
+    needed.
+
+    Every benchmark runs in a process of its own and reports throughput,
+    latency percentiles and the peak resident set size of that process.
+    The memory held by a single Message is reported at the end.
+
+    Run with ``python bench.py [-n COUNT] [-k PATTERN]``.
+"""
+
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+import tracemalloc
+import warnings
+
+from flask import Flask
+from flask_sendmail import Mail, Message
+
+warnings.simplefilter('ignore', DeprecationWarning)
+
+FAKE_SENDMAIL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'fake_sendmail.py')
+
+SMALL_BODY = 'Hello,\n\nthanks for signing up.\n'
+LARGE_BODY = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n' * 4096
+UNICODE_BODY = 'Grüße aus Köln, Łódź und 東京 ✉\n' * 64
+HTML_BODY = '<p>Lorem ipsum <b>dolor</b> sit amet.</p>\n' * 64
+
+# batch mode is opt-in; the bulk benchmarks measure one mailer process
+# reused for every message, as fake_sendmail.py supports
+BATCH_FLAGS = '-bs'
+
+
+def make_app(**config):
+    app = Flask(__name__)
+    app.config.update(DEFAULT_MAIL_SENDER='support@example.com',
+                      MAIL_MAILER=FAKE_SENDMAIL, **config)
+    return app, Mail(app)
+
+
+def recipients(count):
+    return ('user%d@example.com' % i for i in range(count))
+
+
+def template():
+    return Message(subject='Hello $name',
+                   body='Dear $name,\n\n' + 'Lorem ipsum dolor sit amet. ' * 40,
+                   html='<p>Dear $name,</p>' + '<p>Lorem ipsum</p>' * 40)
+
+
+def context(recipient):
+    return {'name': recipient.split('@')[0]}
+
+
+def timed(op, count):
+    """
+    Calls op count times, returning the duration of every call.
+    """
+
+    latencies = []
+    for i in range(count):
+        start = time.perf_counter()
+        op()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_init(count):
+    app, mail = make_app()
+    with app.app_context():
+        return timed(lambda: Message(subject='Hello',
+                                     recipients=['user@example.com'],
+                                     body=SMALL_BODY), count)
+
+
+def bench_is_bad_headers(count):
+    app, mail = make_app()
+    with app.app_context():
+        msg = Message(subject='Hello', recipients=['user@example.com'],
+                      body=SMALL_BODY)
+        return timed(msg.is_bad_headers, count)
+
+
+def bench_is_bad_headers_bulk(count):
+    bcc = list(recipients(5000))
+    return timed(lambda: Message(subject='Hello', recipients=['user@example.com'],
+                                 sender='support@example.com', body=SMALL_BODY,
+                                 bcc=bcc).is_bad_headers(), count)
+
+
+def dump(**body):
+    def bench(count):
+        # measure the encoding of the body, not the render cache
+        app, mail = make_app(MAIL_RENDER_CACHE_SIZE=0)
+        with app.app_context():
+            msg = Message(subject='Hello', recipients=['user@example.com'],
+                          **body)
+            return timed(msg.dump, count)
+    return bench
+
+
+def bench_send(count):
+    app, mail = make_app()
+    with app.app_context():
+        conn = mail.connect()
+        messages = (Message(subject='Hello', recipients=[recipient],
+                            body=SMALL_BODY)
+                    for recipient in recipients(count))
+        return timed(lambda: conn.send(next(messages)), count)
+
+
+def bench_send_batched(count):
+    app, mail = make_app(MAIL_MAILER_BATCH_FLAGS=BATCH_FLAGS)
+    with app.app_context():
+        messages = (Message(subject='Hello', recipients=[recipient],
+                            body=SMALL_BODY)
+                    for recipient in recipients(count))
+        with mail.connect() as conn:
+            return timed(lambda: conn.send(next(messages)), count)
+
+
+def bench_send_loop(count):
+    app, mail = make_app()
+    with app.app_context():
+        for recipient in recipients(count):
+            msg = template()
+            msg.recipients = [recipient]
+            msg.subject = msg.subject.replace('$name', context(recipient)['name'])
+            mail.send(msg)
+
+
+def bench_send_many(count):
+    app, mail = make_app(MAIL_MAILER_BATCH_FLAGS=BATCH_FLAGS)
+    with app.app_context():
+        mail.send_many(template(), recipients(count), context)
+
+
+def bench_send_many_shared_body(count):
+    app, mail = make_app(MAIL_MAILER_BATCH_FLAGS=BATCH_FLAGS)
+    with app.app_context():
+        mail.send_many(template(), recipients(count))
+
+
+# name, function, operations per message of -n.  Functions returning
+# per-operation latencies get percentiles reported; the others are only
+# timed as a whole.
+BENCHMARKS = [
+    ('Message.__init__', bench_init, 10),
+    ('Message.is_bad_headers', bench_is_bad_headers, 10),
+    ('Message.is_bad_headers, 5000 Bcc', bench_is_bad_headers_bulk, 0.1),
+    ('Message.dump, small body', dump(body=SMALL_BODY), 10),
+    ('Message.dump, large body', dump(body=LARGE_BODY), 1),
+    ('Message.dump, unicode body', dump(body=UNICODE_BODY), 10),
+    ('Message.dump, html body', dump(body=SMALL_BODY, html=HTML_BODY), 10),
+    ('Connection.send', bench_send, 1),
+    ('Connection.send, batched', bench_send_batched, 1),
+    ('Mail.send in a loop', bench_send_loop, 1),
+    ('Mail.send_many', bench_send_many, 1),
+    ('Mail.send_many, shared body', bench_send_many_shared_body, 1),
+]
+
+
+def message_size(count):
+    """
+    Returns the memory held by a Message, in bytes, averaged over count
+    messages built outside of an application context.
+    """
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    messages = [Message(subject='Hello', recipients=[recipient],
+                        body=SMALL_BODY)
+                for recipient in recipients(count)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    # the recipient strings belong to the caller, not the message
+    size -= sum(sys.getsizeof(msg.recipients[0]) for msg in messages)
+    return size / float(count)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def peak_rss():
+    # kilobytes on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def measure(func, count, conn):
+    start = time.perf_counter()
+    latencies = func(count)
+    elapsed = time.perf_counter() - start
+    conn.send((elapsed, sorted(latencies or []), peak_rss()))
+    conn.close()
+
+
+def run(name, func, count):
+    # a fresh process per benchmark keeps the peak RSS figures apart
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=measure,
+                                      args=(func, count, sender))
+    process.start()
+    sender.close()
+    elapsed, latencies, rss = receiver.recv()
+    process.join()
+
+    if latencies:
+        p50, p90, p99 = ['%9.1f' % (percentile(latencies, f) * 1e6)
+                         for f in (0.5, 0.9, 0.99)]
+    else:
+        p50 = p90 = p99 = '%9s' % '-'
+    print('%-32s %8d %12.1f %s %s %s %9.1f'
+          % (name, count, count / elapsed, p50, p90, p99, rss / 2.0 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-n', '--count', type=int, default=1000,
+                        help='messages per benchmark')
+    parser.add_argument('-k', '--filter', default='',
+                        help='only run benchmarks whose name contains this')
+    args = parser.parse_args()
+
+    os.environ.pop('FAKE_SENDMAIL_DIR', None)
+    print('%-32s %8s %12s %9s %9s %9s %9s'
+          % ('benchmark', 'ops', 'ops/s', 'p50 us', 'p90 us', 'p99 us',
+             'RSS MiB'))
+    for name, func, scale in BENCHMARKS:
+        if args.filter.lower() in name.lower():
+            run(name, func, int(args.count * scale))
+    print('\nmemory per Message: %.0f bytes' % message_size(args.count))
+
+
+if __name__ == '__main__':
+    main()
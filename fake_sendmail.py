@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+"""
+    fake_sendmail
+    ~~~~~~~~~~~~~
+
+    Stand-in for the system's sendmail client, used by the tests.
+
+    Understands ``-t`` (read one message from stdin) and ``-bs`` (SMTP
+    over stdin/stdout).  Every delivered message is written to
+    ``$FAKE_SENDMAIL_DIR`` as ``<id>.eml`` together with a ``<id>.json``
+    envelope describing how it was received.
+
+    Behaviour can be altered through the environment:
+
+    * ``FAKE_SENDMAIL_EXIT`` -- exit status used in ``-t`` mode
+    * ``FAKE_SENDMAIL_NO_BS`` -- refuse ``-bs`` mode like a minimal mailer
+    * ``FAKE_SENDMAIL_IGNORE_BS`` -- ignore ``-bs`` and read stdin silently
+    * ``FAKE_SENDMAIL_DATA_REPLY`` -- reply sent after ``DATA`` in ``-bs`` mode
+    * ``FAKE_SENDMAIL_STALL`` -- command in ``-bs`` mode never answered,
+      ``DATA`` meaning the reply after the message
+"""
+
+import json
+import os
+import sys
+import time
+
+_counter = [0]
+
+
+def deliver(data, **envelope):
+    directory = os.environ.get('FAKE_SENDMAIL_DIR')
+    if not directory:
+        return
+    _counter[0] += 1
+    name = '%d-%d-%d' % (time.time() * 1e6, os.getpid(), _counter[0])
+    envelope.update(pid=os.getpid(), argv=sys.argv[1:])
+    with open(os.path.join(directory, name + '.tmp'), 'wb') as fp:
+        fp.write(data)
+    with open(os.path.join(directory, name + '.json'), 'w') as fp:
+        json.dump(envelope, fp)
+    os.rename(os.path.join(directory, name + '.tmp'),
+              os.path.join(directory, name + '.eml'))
+
+
+def exec_mode(args):
+    data = sys.stdin.buffer.read()
+    sender = None
+    recipients = []
+    if '-f' in args:
+        sender = args[args.index('-f') + 1]
+    if '--' in args:
+        recipients = args[args.index('--') + 1:]
+    status = int(os.environ.get('FAKE_SENDMAIL_EXIT', 0))
+    if status:
+        sys.stderr.write('fake_sendmail: failing with %d\n' % status)
+        return status
+    deliver(data, mode='exec', sender=sender, recipients=recipients)
+    return 0
+
+
+def smtp_mode():
+    stdin = sys.stdin.buffer
+    stdout = sys.stdout.buffer
+
+    def reply(*lines):
+        for line in lines:
+            stdout.write(line.encode('ascii') + b'\r\n')
+        stdout.flush()
+
+    reply('220 localhost fake_sendmail ready')
+    sender, recipients = None, []
+    while True:
+        line = stdin.readline()
+        if not line:
+            return 0
+        command = line.decode('ascii').strip()
+        verb = command.split(' ', 1)[0].upper()
+        if verb == os.environ.get('FAKE_SENDMAIL_STALL') and verb != 'DATA':
+            time.sleep(3600)
+        if verb == 'EHLO':
+            reply('250-localhost', '250-PIPELINING', '250 8BITMIME')
+        elif verb == 'HELO':
+            reply('250 localhost')
+        elif verb == 'MAIL':
+            sender, recipients = command[10:].strip('<>'), []
+            reply('250 ok')
+        elif verb == 'RCPT':
+            recipients.append(command[8:].strip('<>'))
+            reply('250 ok')
+        elif verb == 'DATA':
+            reply('354 go ahead')
+            lines = []
+            while True:
+                line = stdin.readline()
+                if line in (b'.\r\n', b'.\n', b''):
+                    break
+                if line.startswith(b'..'):
+                    line = line[1:]
+                lines.append(line)
+            if os.environ.get('FAKE_SENDMAIL_STALL') == 'DATA':
+                time.sleep(3600)
+            data_reply = os.environ.get('FAKE_SENDMAIL_DATA_REPLY',
+                                        '250 queued')
+            if data_reply.startswith('2'):
+                deliver(b''.join(lines), mode='smtp', sender=sender,
+                        recipients=recipients)
+            reply(data_reply)
+            sender, recipients = None, []
+        elif verb in ('RSET', 'NOOP'):
+            sender, recipients = None, []
+            reply('250 ok')
+        elif verb == 'QUIT':
+            reply('221 bye')
+            return 0
+        else:
+            reply('500 unrecognized command')
+
+
+def main(args):
+    if '-bs' in args:
+        if os.environ.get('FAKE_SENDMAIL_IGNORE_BS'):
+            sys.stdin.buffer.read()
+            return 0
+        if os.environ.get('FAKE_SENDMAIL_NO_BS'):
+            sys.stderr.write('fake_sendmail: -bs not supported\n')
+            return 64
+        return smtp_mode()
+    return exec_mode(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -17,5 +17,10 @@
 __version__ = '0.2'
 
 from .mail import Mail
-from .message import Message, BadHeaderError
+from .message import Message, Attachment, BadHeaderError
 from .connection import Connection
+from .aio import AsyncConnection
+from .transport import SendmailTransport, SMTPTransport
+from .background import QueueFull
+from .metrics import DeliveryError, DeliveryResult, MetricsSink
+from .signals import email_dispatched
@@ -0,0 +1,209 @@
+import asyncio
+import tempfile
+from asyncio.subprocess import PIPE
+from time import perf_counter
+
+from .channel import EX_OK, ChannelError, ExecChannel, envelope_mode, \
+    mailer_commands
+from .connection import retry_delay
+from .metrics import DeliveryError, DeliveryResult, record, record_suppressed
+
+# bytes of a message kept in memory while it is written to the mailer;
+# larger messages are set aside in a temporary file
+SPOOL_SIZE = 1024 * 1024
+# largest write to the mailer's stdin
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class AsyncExecChannel(object):
+    """
+    Spawns the mailer once for every message, without blocking the
+    event loop.
+
+    The message is serialized once, into memory up to SPOOL_SIZE bytes and
+    to a temporary file beyond, and written to the mailer in chunks, each
+    waiting for the mailer to take the previous one.
+
+    :param mail: Mail instance
+    """
+
+    alive = True
+
+    def __init__(self, mail):
+        self.mail = mail
+        self.sent = 0
+
+    async def send(self, message):
+        if self.mail.zygote is not None:
+            # the helper is reached over a blocking socket
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(
+                None, ExecChannel(self.mail).send, message)
+
+        result = DeliveryResult(EX_OK)
+        delivered = False
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE) as data:
+            start = perf_counter()
+            message.write_to(data, not envelope_mode(self.mail, message))
+            result.serialize = perf_counter() - start
+
+            for command in mailer_commands(self.mail, message):
+                data.seek(0)
+                start = perf_counter()
+                sm = await asyncio.create_subprocess_exec(
+                    *command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+                spawned = perf_counter()
+                result.bytes += await _feed(sm.stdin, data)
+                sm.stdin.close()
+                written = perf_counter()
+                out, stderr = await sm.communicate()
+
+                result.spawn += spawned - start
+                result.write += written - spawned
+                result.wait += perf_counter() - written
+                result.stderr += stderr
+                if not result.returncode:
+                    result.returncode = sm.returncode
+                if sm.returncode == EX_OK:
+                    delivered = True
+        result.partial = delivered and result.returncode != EX_OK
+        self.sent += 1
+
+        return result
+
+    async def close(self):
+        pass
+
+
+class AsyncThreadChannel(object):
+    """
+    Runs a blocking channel in the default executor, for transports
+    without an asyncio implementation.
+
+    :param channel: channel to wrap
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    @property
+    def alive(self):
+        return self.channel.alive
+
+    async def send(self, message):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.channel.send, message)
+
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.channel.close)
+
+
+class AsyncConnection(object):
+    """
+    asyncio counterpart of Connection::
+
+        async with mail.connect_async() as conn:
+            for user in users:
+                await conn.send(Message(...))
+
+    :param mail: Mail instance
+    :param max_emails: number of messages after which the mailer process
+                       is replaced
+    """
+
+    def __init__(self, mail, max_emails=None):
+        self.mail = mail
+        self.max_emails = max_emails or self.mail.max_emails or 0
+        self.channel = None
+        self.num_emails = 0
+
+    async def __aenter__(self):
+        if self.mail.suppress:
+            return self
+        self.channel = await self._open()
+        self.num_emails = 0
+        return self
+
+    async def _open(self):
+        try:
+            return await self.mail.transport.open_async()
+        except ChannelError:
+            # messages are sent one by one until the mailer is reachable
+            return None
+
+    async def _reopen(self):
+        await self.channel.close()
+        self.channel = None
+        self.channel = await self._open()
+        self.num_emails = 0
+
+    async def send(self, message):
+        message._bind(self.mail)
+        if self.mail.suppress:
+            return record_suppressed(self.mail, message)
+
+        result = await self._deliver(message)
+        delay = retry_delay(self.mail, result)
+        while delay is not None:
+            await asyncio.sleep(delay)
+            attempts = result.attempts
+            result = await self._deliver(message)
+            result.attempts = attempts + 1
+            delay = retry_delay(self.mail, result)
+
+        record(self.mail, message, result)
+        if not result.ok and not self.mail.fail_silently:
+            raise DeliveryError(result)
+        return result
+
+    async def _deliver(self, message):
+        if self.mail.throttle is not None:
+            delay = self.mail.throttle.reserve(message)
+            if delay:
+                await asyncio.sleep(delay)
+
+        if self.channel is None:
+            return await self.mail.transport.send_async(message)
+
+        if not self.channel.alive or (
+                self.max_emails and self.num_emails >= self.max_emails):
+            await self._reopen()
+            if self.channel is None:
+                # the mailer cannot be reached again for now
+                return await self.mail.transport.send_async(message)
+
+        try:
+            result = await self.channel.send(message)
+        except ChannelError:
+            await self._reopen()
+            try:
+                if self.channel is None:
+                    raise ChannelError("mailer unavailable")
+                result = await self.channel.send(message)
+            except ChannelError:
+                result = await self.mail.transport.send_async(message)
+
+        self.num_emails += 1
+        return result
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        if self.channel is not None:
+            await self.channel.close()
+            self.channel = None
+
+
+async def _feed(stdin, fp):
+    # copies fp to the mailer's stdin, returning the bytes it took
+    size = 0
+    while True:
+        chunk = fp.read(WRITE_CHUNK_SIZE)
+        if not chunk:
+            return size
+        stdin.write(chunk)
+        try:
+            await stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # the mailer gave up early; its return code tells us why
+            return size
+        size += len(chunk)
@@ -0,0 +1,196 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import monotonic
+
+# message priorities, most urgent first
+CRITICAL = 'critical'
+NORMAL = 'normal'
+BULK = 'bulk'
+PRIORITIES = (CRITICAL, NORMAL, BULK)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Scheduler(object):
+    """
+    Queue of messages for every priority.
+
+    Messages of one priority leave in order.  Across priorities the
+    queues take turns in proportion to their weights (smooth weighted
+    round robin), so that bulk mail keeps moving while more urgent mail
+    goes first.
+
+    :param weights: mapping of priority to weight
+    :param queue_size: number of messages each queue holds
+    """
+
+    def __init__(self, weights, queue_size):
+        self.weights = weights
+        self.queue_size = queue_size
+        self._queues = dict((priority, deque()) for priority in weights)
+        self._credit = dict((priority, 0) for priority in weights)
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def put(self, priority, item, timeout=None):
+        """
+        Queues item, waiting while the queue of its priority is full.
+
+        Raises QueueFull once timeout has passed.
+        """
+
+        queue = self._queues[priority]
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            while len(queue) >= self.queue_size:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise QueueFull("%d %s messages already queued"
+                                        % (self.queue_size, priority))
+                self._cond.wait(remaining)
+            queue.append(item)
+            self._cond.notify_all()
+
+    def get(self, priorities=None):
+        """
+        Returns the next item from the given priorities, all by default,
+        waiting for one if need be.
+
+        Returns None once the scheduler is closed and those queues are
+        empty.
+        """
+
+        priorities = priorities or PRIORITIES
+        with self._cond:
+            while True:
+                ready = [p for p in priorities if self._queues[p]]
+                if ready:
+                    break
+                if self._closed:
+                    return None
+                self._cond.wait()
+
+            if len(ready) == 1:
+                priority = ready[0]
+            else:
+                total = 0
+                for p in ready:
+                    self._credit[p] += self.weights[p]
+                    total += self.weights[p]
+                priority = max(ready, key=self._credit.get)
+                self._credit[priority] -= total
+            item = self._queues[priority].popleft()
+            self._cond.notify_all()
+            return item
+
+    def pending(self):
+        """
+        Returns the number of messages waiting, by priority.
+        """
+
+        with self._cond:
+            return dict((p, len(queue)) for p, queue in self._queues.items())
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class BackgroundSender(object):
+    """
+    Bounded thread pool sending messages off the request thread.
+
+    Messages wait in a queue for their priority, of ``queue_size``
+    messages each; further submissions block until a slot frees up, or
+    raise QueueFull once ``timeout`` has passed.  ``threads`` threads send
+    messages of every priority, taking turns by ``weights``, and
+    ``critical_threads`` more are kept for critical messages alone.
+
+    :param mail: Mail instance
+    :param threads: number of sending threads
+    :param queue_size: number of messages waiting for a thread, for each
+                       priority
+    :param critical_threads: number of threads sending critical messages
+                             only
+    :param weights: mapping of priority to weight
+    """
+
+    def __init__(self, mail, threads, queue_size, critical_threads=1,
+                 weights=None):
+        self.mail = mail
+        self.threads = threads
+        self.queue_size = queue_size
+        self.critical_threads = critical_threads
+        self.weights = weights or {CRITICAL: 8, NORMAL: 4, BULK: 1}
+        self.scheduler = None
+        self._workers = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self.scheduler is not None and self._pid == os.getpid():
+                return self.scheduler
+            self.scheduler = Scheduler(self.weights, self.queue_size)
+            self._pid = os.getpid()
+            self._workers = []
+            lanes = ([None] * self.threads
+                     + [(CRITICAL,)] * self.critical_threads)
+            for priorities in lanes:
+                worker = threading.Thread(
+                    target=self._work, args=(self.scheduler, priorities),
+                    name='flask-sendmail', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+            return self.scheduler
+
+    def _work(self, scheduler, priorities):
+        while True:
+            item = scheduler.get(priorities)
+            if item is None:
+                return
+            message, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.mail.connect().send(message))
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, message, timeout=None):
+        """
+        Queues a message and returns a Future for its DeliveryResult.
+
+        :param message: Message instance
+        :param timeout: seconds to wait for a free slot, or None to wait
+                        indefinitely
+        """
+
+        priority = getattr(message, 'priority', None) or NORMAL
+        if priority not in PRIORITIES:
+            raise ValueError("unknown priority %r" % priority)
+
+        future = Future()
+        self._start().put(priority, (message, future), timeout)
+        return future
+
+    def shutdown(self, wait=True):
+        """
+        Stops the sending threads, by default after the queue is drained.
+        """
+
+        with self._lock:
+            scheduler, self.scheduler = self.scheduler, None
+            workers, self._workers = self._workers, []
+        if scheduler is not None:
+            scheduler.close()
+            if wait and self._pid == os.getpid():
+                for worker in workers:
+                    worker.join()
@@ -0,0 +1,652 @@
+import base64
+import os
+import socket
+import ssl
+import select
+from subprocess import DEVNULL, PIPE, Popen
+from time import monotonic, perf_counter
+
+from .metrics import EX_DATAERR, EX_IOERR, EX_NOUSER, EX_OK, EX_PROTOCOL, \
+    EX_TEMPFAIL, DeliveryResult, MeteredWriter
+from .zygote import ZygoteError
+
+# bytes of recipient arguments passed to one run of the mailer, well
+# below the smallest ARG_MAX in use
+ARGV_BUDGET = 64 * 1024
+
+
+class ChannelError(Exception):
+    pass
+
+
+class ExecChannel(object):
+    """
+    Spawns the mailer once for every message.
+
+    In envelope mode the sender and recipients are passed as arguments
+    instead of being read from the headers, spread over as many runs of
+    the mailer as the recipient list needs.
+
+    With **MAIL_ZYGOTE** the mailer is run by the helper process instead,
+    or by this process if the helper cannot be reached.
+
+    :param mail: Mail instance
+    """
+
+    alive = True
+
+    def __init__(self, mail):
+        self.mail = mail
+        self.pid = os.getpid()
+        self.sent = 0
+        self.last_used = monotonic()
+
+    def send(self, message):
+        result = DeliveryResult(EX_OK)
+        include_bcc = not envelope_mode(self.mail, message)
+        commands = mailer_commands(self.mail, message)
+        zygote = self.mail.zygote
+        if len(commands) > 1:
+            # serialize once for all runs of the mailer
+            start = perf_counter()
+            data = message.dump(include_bcc)
+            result.serialize = perf_counter() - start
+            source = _Serialized(data)
+        else:
+            source = message
+
+        delivered = False
+        for command in commands:
+            returncode = None
+            if zygote is not None:
+                returncode = self._run_in_zygote(zygote, command, source,
+                                                 include_bcc, result)
+            if returncode is None:
+                returncode = self._run(command, source, include_bcc, result)
+            if not result.returncode:
+                # the first failure is the one reported
+                result.returncode = returncode
+            if returncode == EX_OK:
+                delivered = True
+        result.partial = delivered and result.returncode != EX_OK
+        self.sent += 1
+
+        self.last_used = monotonic()
+        return result
+
+    def _run(self, command, source, include_bcc, result):
+        start = perf_counter()
+        sm = Popen(command, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        spawned = perf_counter()
+        writer = MeteredWriter(sm.stdin.write)
+        try:
+            source.write_to(writer, include_bcc)
+        except BrokenPipeError:
+            # the mailer gave up early; its return code tells us why
+            pass
+        written = perf_counter()
+        out, stderr = sm.communicate()
+
+        result.spawn += spawned - start
+        result.write += writer.elapsed
+        result.serialize += written - spawned - writer.elapsed
+        result.wait += perf_counter() - written
+        result.bytes += writer.bytes
+        result.stderr += stderr
+        return sm.returncode
+
+    def _run_in_zygote(self, zygote, command, source, include_bcc, result):
+        start = perf_counter()
+        try:
+            returncode, stderr, spawn, wait, size = zygote.run(
+                command, source, include_bcc)
+        except ZygoteError:
+            # the mailer was not run; run it ourselves
+            return None
+
+        result.spawn += spawn
+        result.wait += wait
+        # serializing the message and writing it out overlap
+        result.write += perf_counter() - start - spawn - wait
+        result.bytes += size
+        result.stderr += stderr
+        return returncode
+
+    def ping(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class SMTPClient(object):
+    """
+    Client side of an SMTP or LMTP session, shared by the channels that
+    speak the protocol.
+
+    Subclasses provide the transport through _readline(), _write(),
+    _flush() and _shutdown(), and call _greet() once connected.
+
+    :param mail: Mail instance
+    """
+
+    lmtp = False
+
+    def __init__(self, mail):
+        self.mail = mail
+        self.pid = os.getpid()
+        self.sent = 0
+        self.alive = False
+        self.extensions = {}
+        self.local_hostname = socket.gethostname() or 'localhost'
+        self.last_used = monotonic()
+
+    def _greet(self):
+        code, lines = self._reply()
+        if code != 220:
+            raise ChannelError("mailer refused the session: %r" % lines)
+        self._hello()
+
+    def _hello(self):
+        if self.lmtp:
+            code, lines = self._command('LHLO %s' % self.local_hostname)
+        else:
+            code, lines = self._command('EHLO %s' % self.local_hostname)
+            if code != 250:
+                code, lines = self._command('HELO %s' % self.local_hostname)
+        if code != 250:
+            raise ChannelError("mailer refused greeting: %r" % lines)
+
+        # the first line greets us, the others name the extensions
+        self.extensions = {}
+        for line in lines[1:]:
+            keyword, sep, params = line.decode('ascii', 'replace').partition(' ')
+            self.extensions[keyword.upper()] = params
+
+    def _readline(self):
+        raise NotImplementedError
+
+    def _write(self, data):
+        raise NotImplementedError
+
+    def _flush(self):
+        raise NotImplementedError
+
+    def _shutdown(self):
+        raise NotImplementedError
+
+    def _reply(self):
+        lines = []
+        while True:
+            line = self._readline()
+            if not line:
+                self.alive = False
+                raise ChannelError("mailer closed the connection")
+            lines.append(line[4:].rstrip())
+            if line[3:4] != b'-':
+                break
+        try:
+            return int(line[:3]), lines
+        except ValueError:
+            self.alive = False
+            raise ChannelError("malformed reply from mailer: %r" % line)
+
+    def _command(self, command):
+        self._write(command.encode('ascii') + b'\r\n')
+        self._flush()
+        return self._reply()
+
+    def ping(self):
+        """
+        Checks that the mailer still answers.
+        """
+
+        try:
+            code, lines = self._command('NOOP')
+        except ChannelError:
+            return False
+        return code == 250
+
+    def send(self, message):
+        """
+        Sends a message through the open session.
+
+        Raises ChannelError if the message could not be handed over, in
+        which case it has not been delivered and may be sent again.
+
+        :param message: Message instance
+        """
+
+        if not ascii_envelope(message):
+            return self._send_non_ascii(message)
+
+        result = DeliveryResult()
+        start = perf_counter()
+        result.returncode = self._transaction(message, result)
+        result.wait = (perf_counter() - start - result.serialize
+                       - result.write)
+        self.last_used = monotonic()
+        return result
+
+    def _send_non_ascii(self, message):
+        # addresses SMTP cannot carry without SMTPUTF8, which is not
+        # supported
+        return DeliveryResult(EX_DATAERR, stderr=b"non-ASCII envelope "
+                              b"addresses need SMTPUTF8")
+
+    def _rejected(self, result, code, lines):
+        result.stderr = b'\n'.join(lines)
+        self._command('RSET')
+        return _exit_status(code)
+
+    def _envelope(self, message):
+        recipients = sorted(message.send_to)
+        commands = (['MAIL FROM:<%s>' % message.envelope_sender]
+                    + ['RCPT TO:<%s>' % recipient for recipient in recipients]
+                    + ['DATA'])
+
+        if 'PIPELINING' in self.extensions:
+            # RFC 2920: the whole envelope goes out in one write and the
+            # replies are read afterwards
+            self._write(''.join(command + '\r\n' for command in commands)
+                        .encode('ascii'))
+            self._flush()
+            replies = [self._reply() for command in commands]
+        else:
+            replies = [self._command(commands[0])]
+            if replies[0][0] == 250:
+                replies.extend(self._command(command)
+                               for command in commands[1:-1])
+        return recipients, replies
+
+    def _transaction(self, message, result):
+        recipients, replies = self._envelope(message)
+        # only there if the commands were pipelined
+        data_reply = replies[len(recipients) + 1:]
+
+        code, lines = replies[0]
+        if code != 250:
+            self._abort(data_reply)
+            return self._rejected(result, code, lines)
+
+        status = EX_OK
+        accepted = []
+        for recipient, (code, lines) in zip(recipients, replies[1:]):
+            if code in (250, 251):
+                accepted.append(recipient)
+            else:
+                status = _exit_status(code)
+                result.stderr = b'\n'.join(lines)
+
+        if not accepted:
+            self._abort(data_reply)
+            self._command('RSET')
+            return status
+
+        code, lines = data_reply[0] if data_reply else self._command('DATA')
+        if code != 354:
+            return self._rejected(result, code, lines)
+
+        start = perf_counter()
+        metered = MeteredWriter(self._write)
+        writer = DataWriter(metered.write)
+        message.write_to(writer, include_bcc=False)
+        writer.close()
+        result.write = metered.elapsed
+        result.serialize = perf_counter() - start - metered.elapsed
+        result.bytes = metered.bytes
+
+        # once the terminating dot is out the message may have been
+        # queued, so it must not be handed to another channel
+        try:
+            self._flush()
+            # an LMTP server answers for every recipient
+            replies = [self._reply() for r in (accepted if self.lmtp else [0])]
+        except ChannelError:
+            self.alive = False
+            return EX_IOERR
+        self.sent += 1
+
+        for code, lines in replies:
+            if code != 250:
+                result.stderr = b'\n'.join(lines)
+                status = _exit_status(code)
+        if status != EX_OK and any(code == 250 for code, lines in replies):
+            result.partial = True
+        return status
+
+    def _abort(self, data_reply):
+        # a server that accepted the pipelined DATA although the envelope
+        # failed is waiting for a message; give it an empty one
+        if data_reply and data_reply[0][0] == 354:
+            self._write(b'.\r\n')
+            self._flush()
+            self._reply()
+
+    def close(self):
+        if self.alive:
+            try:
+                self._command('QUIT')
+            except ChannelError:
+                pass
+        self.alive = False
+        self._shutdown()
+
+
+class BatchChannel(SMTPClient):
+    """
+    Long-lived mailer process speaking SMTP over its stdin and stdout
+    (``sendmail -bs``), reused for many messages.
+
+    Raises ChannelError if the mailer does not answer as an SMTP server.
+    A mailer that leaves any command unanswered for
+    **MAIL_MAILER_BATCH_TIMEOUT** seconds, the greeting included, is
+    killed and the channel is dead.
+
+    :param mail: Mail instance
+    """
+
+    def __init__(self, mail):
+        super(BatchChannel, self).__init__(mail)
+        self.timeout = mail.mailer_batch_timeout
+        self._buffer = b''
+
+        try:
+            self.process = Popen([mail.mailer, mail.mailer_batch_flags],
+                                 stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+        except OSError as e:
+            raise ChannelError(str(e))
+
+        self.alive = True
+        try:
+            self._greet()
+        except ChannelError:
+            self.close()
+            raise
+
+    def _send_non_ascii(self, message):
+        # the mailer takes such addresses from its command line or headers
+        return ExecChannel(self.mail).send(message)
+
+    def _readline(self):
+        # replies are read from the pipe itself rather than through its
+        # buffered reader, so select() sees whatever is left to read
+        while b'\n' not in self._buffer:
+            try:
+                fd = self.process.stdout.fileno()
+                ready, w, x = select.select([fd], [], [], self.timeout)
+                chunk = os.read(fd, 65536) if ready else None
+            except (OSError, ValueError):
+                chunk = b''
+            if chunk is None:
+                # a mailer ignoring the batch flags sits reading its stdin
+                # and never answers, and one may stall at any point
+                self.alive = False
+                self.process.kill()
+                raise ChannelError("mailer did not answer within %s seconds"
+                                   % self.timeout)
+            if not chunk:
+                line, self._buffer = self._buffer, b''
+                return line
+            self._buffer += chunk
+        line, sep, self._buffer = self._buffer.partition(b'\n')
+        return line + sep
+
+    def _write(self, data):
+        try:
+            self.process.stdin.write(data)
+        except (OSError, ValueError):
+            self.alive = False
+            raise ChannelError("mailer closed the connection")
+
+    def _flush(self):
+        try:
+            self.process.stdin.flush()
+        except (OSError, ValueError):
+            self.alive = False
+            raise ChannelError("mailer closed the connection")
+
+    def _shutdown(self):
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except (OSError, ValueError):
+                pass
+        self.process.wait()
+
+
+class SMTPChannel(SMTPClient):
+    """
+    Session with an SMTP or LMTP server over the network, or over a unix
+    socket if ``host`` is a path.
+
+    Raises ChannelError if the server cannot be reached or refuses the
+    session.
+
+    :param mail: Mail instance
+    :param host: server name or address, or path of a unix socket
+    :param port: server port
+    :param lmtp: speak LMTP instead of SMTP
+    :param username: user to authenticate as, if any
+    :param password: password of the user
+    :param starttls: upgrade the connection with ``STARTTLS``
+    :param use_ssl: connect over TLS from the start
+    :param ssl_context: ``ssl.SSLContext`` used for TLS
+    :param timeout: socket timeout in seconds
+    """
+
+    def __init__(self, mail, host, port, lmtp=False, username=None,
+                 password=None, starttls=False, use_ssl=False,
+                 ssl_context=None, timeout=None):
+        super(SMTPChannel, self).__init__(mail)
+        self.lmtp = lmtp
+        self.host = host
+
+        try:
+            if host.startswith('/'):
+                sock = socket.socket(socket.AF_UNIX)
+                sock.settimeout(timeout)
+                sock.connect(host)
+            else:
+                sock = socket.create_connection((host, port), timeout)
+        except OSError as e:
+            raise ChannelError(str(e))
+
+        self._attach(sock)
+        self.alive = True
+        try:
+            if use_ssl:
+                self._wrap(ssl_context)
+            self._greet()
+            if starttls:
+                self._starttls(ssl_context)
+            if username is not None:
+                self._login(username, password)
+        except (ChannelError, OSError) as e:
+            self.close()
+            raise ChannelError(str(e))
+
+    def _attach(self, sock):
+        self.sock = sock
+        self._rfile = sock.makefile('rb')
+        self._wfile = sock.makefile('wb')
+
+    def _wrap(self, ssl_context):
+        if ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        self._rfile.close()
+        self._wfile.close()
+        server_hostname = None if self.host.startswith('/') else self.host
+        self._attach(ssl_context.wrap_socket(self.sock,
+                                             server_hostname=server_hostname))
+
+    def _starttls(self, ssl_context):
+        if 'STARTTLS' not in self.extensions:
+            raise ChannelError("server does not offer STARTTLS")
+        code, lines = self._command('STARTTLS')
+        if code != 220:
+            raise ChannelError("server refused STARTTLS: %r" % lines)
+        self._wrap(ssl_context)
+        # RFC 3207: everything learnt before the handshake is forgotten
+        self._hello()
+
+    def _login(self, username, password):
+        mechanisms = self.extensions.get('AUTH', '').upper().split()
+        if 'PLAIN' in mechanisms:
+            code, lines = self._command('AUTH PLAIN ' + _b64(
+                '\0%s\0%s' % (username, password)))
+        elif 'LOGIN' in mechanisms:
+            code, lines = self._command('AUTH LOGIN')
+            if code == 334:
+                code, lines = self._command(_b64(username))
+            if code == 334:
+                code, lines = self._command(_b64(password))
+        else:
+            raise ChannelError("server offers no supported AUTH mechanism: "
+                               "%r" % mechanisms)
+        if code != 235:
+            raise ChannelError("authentication failed: %r" % lines)
+
+    def _readline(self):
+        try:
+            return self._rfile.readline()
+        except (OSError, ValueError):
+            return b''
+
+    def _write(self, data):
+        try:
+            self._wfile.write(data)
+        except (OSError, ValueError):
+            self.alive = False
+            raise ChannelError("server closed the connection")
+
+    def _flush(self):
+        try:
+            self._wfile.flush()
+        except (OSError, ValueError):
+            self.alive = False
+            raise ChannelError("server closed the connection")
+
+    def _shutdown(self):
+        for stream in (self._wfile, self._rfile, self.sock):
+            try:
+                stream.close()
+            except (OSError, ValueError):
+                pass
+
+
+class DataWriter(object):
+    """
+    File-like wrapper turning a serialized message into SMTP ``DATA``:
+    CRLF line endings, dot-stuffed, ended by a line with a single dot.
+
+    :param write: callable receiving the converted bytes
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self._bol = True
+
+    def write(self, data):
+        if not data:
+            return
+        if self._bol and data[:1] == b'.':
+            data = b'.' + data
+        data = data.replace(b'\n.', b'\n..').replace(b'\n', b'\r\n')
+        self._write(data)
+        self._bol = data[-1:] == b'\n'
+
+    def close(self):
+        if not self._bol:
+            self._write(b'\r\n')
+        self._write(b'.\r\n')
+
+
+def mailer_commands(mail, message):
+    """
+    Returns the command lines running the mailer for a message.
+
+    That is a single ``mailer MAIL_MAILER_FLAGS`` run, or in envelope mode
+    one run for every **MAIL_ENVELOPE_MAX_RECIPIENTS** recipients, or for
+    as many as fit in the argument list.
+
+    :param mail: Mail instance
+    :param message: Message instance
+    """
+
+    if not envelope_mode(mail, message):
+        return [[mail.mailer, mail.mailer_flags]]
+
+    prefix = [mail.mailer, mail.mailer_envelope_flags]
+    if message.envelope_sender:
+        prefix += ['-f', message.envelope_sender]
+    prefix.append('--')
+
+    commands = []
+    chunk = []
+    size = 0
+    for recipient in sorted(message.send_to):
+        if chunk and (len(chunk) >= mail.envelope_max_recipients
+                      or size + len(recipient) + 1 > ARGV_BUDGET):
+            commands.append(prefix + chunk)
+            chunk = []
+            size = 0
+        chunk.append(recipient)
+        size += len(recipient) + 1
+    commands.append(prefix + chunk)
+    return commands
+
+
+def ascii_envelope(message):
+    """
+    Whether the sender and recipients of a message can be given to an
+    SMTP server as they are, without the SMTPUTF8 extension.
+
+    :param message: Message instance
+    """
+
+    sender = message.envelope_sender or ''
+    return sender.isascii() and ''.join(message.send_to).isascii()
+
+
+def envelope_mode(mail, message):
+    """
+    Whether message is handed to the mailer with its sender and
+    recipients as arguments: in envelope mode, and for coalesced
+    envelopes, whose recipients are not in the headers.
+
+    :param mail: Mail instance
+    :param message: Message instance
+    """
+
+    return mail.envelope_mode or getattr(message, 'envelope_only', False)
+
+
+class _Serialized(object):
+    # a message serialized ahead of time, written out as is; the Bcc
+    # header was already left out if need be
+
+    def __init__(self, data):
+        self.data = data
+
+    def write_to(self, fp, include_bcc=True):
+        fp.write(self.data)
+
+
+def _exit_status(code):
+    # permanent rejections map to codes outside the default
+    # MAIL_RETRY_CODES, so they are not retried
+    if 400 <= code < 500:
+        return EX_TEMPFAIL
+    if code in (550, 551, 553):
+        return EX_NOUSER
+    if 500 <= code < 510:
+        # the command itself was not understood
+        return EX_PROTOCOL
+    if 500 <= code < 600:
+        return EX_DATAERR
+    return EX_PROTOCOL
+
+
+def _b64(text):
+    return base64.b64encode(text.encode('utf-8')).decode('ascii')
@@ -0,0 +1,140 @@
+from .message import Message, _format_address
+from .metrics import EX_OK, DeliveryResult
+
+
+class Envelope(object):
+    """
+    A single copy of a message, addressed to the recipients of several
+    messages that differ only in their envelope.
+
+    The Bcc header is always left out and the recipients are given to the
+    mailer explicitly, as in envelope mode.
+
+    :param message: Message whose content is sent
+    :param recipients: envelope recipients
+    """
+
+    envelope_only = True
+
+    def __init__(self, message, recipients):
+        self.message = message
+        self.envelope_sender = message.envelope_sender
+        self.send_to = frozenset(recipients)
+
+    def write_to(self, fp, include_bcc=False):
+        self.message.write_to(fp, include_bcc=False)
+
+    def dump(self, include_bcc=False):
+        return self.message.dump(include_bcc=False)
+
+
+def content_key(message):
+    """
+    Returns a key shared by the messages that serialize to the same bytes
+    once the Bcc header is left out, or None if message cannot be
+    coalesced.
+
+    :param message: Message instance
+    """
+
+    if not isinstance(message, Message):
+        return None
+    addresses = message.addresses()
+    reply_to = message.reply_to and _format_address(message.reply_to)
+    return (message.subject, _format_address(message.sender), reply_to,
+            addresses.to, addresses.cc, message.body, message.html,
+            message.charset, tuple(map(id, message.attachments)))
+
+
+def coalesce(messages, max_recipients):
+    """
+    Merges messages that differ only in their envelope into as few
+    deliveries as possible.
+
+    The recipients of every group of such messages are sorted by domain
+    and packed into envelopes of at most max_recipients, keeping the
+    recipients of a domain together so the mail server can reach each
+    domain once.  A recipient of several messages in the group gets a
+    single copy.  Messages that cannot be merged are delivered as they
+    are.
+
+    Returns (message or Envelope, indexes of the messages it carries)
+    pairs.
+
+    :param messages: list of messages
+    :param max_recipients: recipients per envelope
+    """
+
+    groups = {}
+    deliveries = []
+    for index, message in enumerate(messages):
+        key = content_key(message)
+        if key is None:
+            deliveries.append((message, [index]))
+        else:
+            groups.setdefault(key, []).append(index)
+
+    for indexes in groups.values():
+        if len(indexes) == 1:
+            deliveries.append((messages[indexes[0]], indexes))
+            continue
+
+        carriers = {}
+        for index in indexes:
+            for recipient in messages[index].send_to:
+                carriers.setdefault(recipient, []).append(index)
+
+        template = messages[indexes[0]]
+        chunk = []
+        for domain, recipients in _by_domain(carriers):
+            if chunk and len(chunk) + len(recipients) > max_recipients:
+                deliveries.append(_envelope(template, chunk, carriers))
+                chunk = []
+            while len(recipients) > max_recipients:
+                deliveries.append(_envelope(
+                    template, recipients[:max_recipients], carriers))
+                recipients = recipients[max_recipients:]
+            chunk.extend(recipients)
+        if chunk:
+            deliveries.append(_envelope(template, chunk, carriers))
+
+    return deliveries
+
+
+def combine(results):
+    """
+    Returns the DeliveryResult of a message delivered through one or more
+    envelopes.
+
+    :param results: DeliveryResult of every envelope carrying the message
+    """
+
+    combined = DeliveryResult(EX_OK)
+    for result in results:
+        if not combined.returncode:
+            combined.returncode = result.returncode
+        combined.serialize += result.serialize
+        combined.spawn += result.spawn
+        combined.write += result.write
+        combined.wait += result.wait
+        combined.bytes += result.bytes
+        combined.stderr += result.stderr
+        combined.attempts = max(combined.attempts, result.attempts)
+        combined.partial = combined.partial or result.partial
+    if not combined.ok and any(result.ok for result in results):
+        combined.partial = True
+    return combined
+
+
+def _by_domain(carriers):
+    domains = {}
+    for recipient in sorted(carriers):
+        domain = recipient.rpartition('@')[2].lower()
+        domains.setdefault(domain, []).append(recipient)
+    return sorted(domains.items())
+
+
+def _envelope(template, recipients, carriers):
+    indexes = sorted(set(index for recipient in recipients
+                         for index in carriers[recipient]))
+    return Envelope(template, recipients), indexes
@@ -1,32 +1,270 @@
-from subprocess import PIPE, STDOUT, Popen
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 
 from flask_sendmail.message import Message
+from flask_sendmail.background import CRITICAL
+from flask_sendmail.channel import ChannelError
+from flask_sendmail.coalesce import coalesce, combine
+from flask_sendmail.metrics import DeliveryError, record, record_suppressed
 
 
 class Connection(object):
-    """Handles connection to host."""
+    """
+    Handles connection to the mailer, through the transport set by
+    **MAIL_TRANSPORT**.
 
-    def __init__(self, mail, max_emails=None):
+    Used as a context manager, a single mailer process is kept open for
+    every message sent through the connection and replaced after
+    ``max_emails`` messages::
+
+        with mail.connect() as conn:
+            for user in users:
+                conn.send(Message(...))
+
+    Outside of a ``with`` block every message is handed over on its own.
+
+    send() returns a DeliveryResult.  Messages failing with one of
+    **MAIL_RETRY_CODES** are handed over again up to **MAIL_RETRIES**
+    times, waiting longer before every attempt, and DeliveryError is raised
+    for the messages that still fail unless **MAIL_FAIL_SILENTLY** is set.
+    Every attempt waits its turn under **MAIL_MAX_RATE** and
+    **MAIL_MAX_RATE_PER_DOMAIN**.
+
+    With a ``concurrency`` above 1, messages sent inside the ``with`` block
+    are spread over that many mailer processes, each driven by its own
+    thread, and send() returns a ``concurrent.futures.Future`` for the
+    DeliveryResult instead of the result itself.
+
+    With ``coalesce`` (**MAIL_COALESCE** by default) and a ``concurrency``
+    of 1, messages sent inside the ``with`` block are held back and
+    delivered together, up to **MAIL_COALESCE_WINDOW** at a time: messages
+    that differ only in their Bcc recipients are merged into envelopes of
+    at most **MAIL_COALESCE_MAX_RECIPIENTS**, grouped by recipient domain.
+    send() then returns a ``concurrent.futures.Future`` as well.
+
+    While sending is suppressed no mailer is involved at all; messages are
+    only reported to email_dispatched receivers.
+    """
+
+    def __init__(self, mail, max_emails=None, concurrency=None,
+                 coalesce=None):
 
         self.mail = mail
         self.app = self.mail.app
         self.suppress = self.mail.suppress
         self.max_emails = max_emails or self.mail.max_emails or 0
         self.fail_silently = self.mail.fail_silently
+        self.concurrency = concurrency or self.mail.delivery_concurrency or 1
+        if self.mail.pool is not None:
+            # every thread holds on to a pooled channel, leaving those
+            # reserved for critical messages
+            self.concurrency = min(self.concurrency, self.mail.pool.shared)
+        if coalesce is None:
+            coalesce = self.mail.coalesce
+        self.coalesce = coalesce and self.concurrency == 1
+        self.channel = None
+        self.num_emails = 0
+        self._executor = None
+        self._pending = None
+        self._entered = False
 
     def __enter__(self):
-        pass
+        self._entered = True
+        if self.suppress:
+            return self
+
+        if self.concurrency > 1:
+            self._local = threading.local()
+            self._workers = []
+            self._lock = threading.Lock()
+            # keep at most a couple of messages per thread waiting, so a
+            # generator of messages is not drained into memory
+            self._slots = threading.BoundedSemaphore(self.concurrency * 2)
+            self._executor = ThreadPoolExecutor(
+                self.concurrency, thread_name_prefix='flask-sendmail')
+            return self
+
+        self.channel = self._open()
+        self.num_emails = 0
+        if self.coalesce:
+            self._pending = []
+        return self
+
+    def _open(self):
+        try:
+            if self.mail.pool is not None:
+                return self.mail.pool.acquire()
+            return self.mail.transport.open()
+        except ChannelError:
+            # messages are sent one by one until the mailer is reachable
+            return None
+
+    def _close(self, channel):
+        if self.mail.pool is not None:
+            self.mail.pool.release(channel)
+        else:
+            channel.close()
+
+    def _reopen(self):
+        self._close(self.channel)
+        self.channel = None
+        self.channel = self._open()
+        self.num_emails = 0
+
+    def _worker(self):
+        # the connection used by the current delivery thread
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = Connection(self.mail, self.max_emails, concurrency=1,
+                              coalesce=False)
+            conn.__enter__()
+            self._local.connection = conn
+            with self._lock:
+                self._workers.append(conn)
+        return conn
+
+    def _send_concurrently(self, message):
+        try:
+            return self._worker().send(message)
+        finally:
+            self._slots.release()
 
     def send(self, message):
-        sm = Popen([self.mail.mailer, self.mail.mailer_flags], stdin=PIPE,
-                   stdout=PIPE, stderr=STDOUT)
-        sm.stdin.write(message.dump())
-        sm.communicate()
+        message._bind(self.mail)
+        if self.suppress:
+            result = record_suppressed(self.mail, message)
+            # the same type as when delivering: futures only come from
+            # inside a with block
+            if self._entered and (self.concurrency > 1 or self.coalesce):
+                future = Future()
+                future.set_result(result)
+                return future
+            return result
+
+        if self._executor is not None:
+            self._slots.acquire()
+            try:
+                return self._executor.submit(self._send_concurrently, message)
+            except Exception:
+                self._slots.release()
+                raise
 
-        return sm.returncode
+        if self._pending is not None:
+            future = Future()
+            self._pending.append((message, future))
+            if len(self._pending) >= self.mail.coalesce_window:
+                self.flush()
+            return future
+
+        return self._report(message, self._attempt(message))
+
+    def flush(self):
+        """
+        Delivers the messages held back for coalescing.
+        """
+
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        messages = [message for message, future in pending]
+        results = [[] for message in messages]
+        try:
+            for delivery, indexes in coalesce(
+                    messages, self.mail.coalesce_max_recipients):
+                result = self._attempt(delivery)
+                for index in indexes:
+                    results[index].append(result)
+        except Exception as e:
+            # nobody is to wait forever on the messages not handed over
+            for message, future in pending:
+                future.set_exception(e)
+            raise
+
+        for (message, future), outcome in zip(pending, results):
+            try:
+                future.set_result(self._report(message, combine(outcome)))
+            except DeliveryError as e:
+                future.set_exception(e)
+
+    def _attempt(self, message):
+        result = self._deliver(message)
+        delay = retry_delay(self.mail, result)
+        while delay is not None:
+            time.sleep(delay)
+            attempts = result.attempts
+            result = self._deliver(message)
+            result.attempts = attempts + 1
+            delay = retry_delay(self.mail, result)
+        return result
+
+    def _report(self, message, result):
+        record(self.mail, message, result)
+        if not result.ok and not self.fail_silently:
+            raise DeliveryError(result)
+        return result
+
+    def _deliver(self, message):
+        if self.mail.throttle is not None:
+            self.mail.throttle.wait(message)
+
+        if self.channel is None:
+            return self._send_once(message)
+
+        if not self.channel.alive or (
+                self.max_emails and self.num_emails >= self.max_emails):
+            self._reopen()
+            if self.channel is None:
+                # the mailer cannot be reached again for now
+                return self._send_once(message)
+
+        try:
+            result = self.channel.send(message)
+        except ChannelError:
+            # the message never reached the mailer; start over with a
+            # fresh channel
+            self._reopen()
+            try:
+                if self.channel is None:
+                    raise ChannelError("mailer unavailable")
+                result = self.channel.send(message)
+            except ChannelError:
+                result = self.mail.transport.send(message)
+
+        self.num_emails += 1
+        return result
+
+    def _send_once(self, message):
+        pool = self.mail.pool
+        if pool is not None:
+            critical = getattr(message, 'priority', None) == CRITICAL
+            try:
+                with pool.channel(critical) as channel:
+                    return channel.send(message)
+            except ChannelError:
+                # the message never reached the mailer, so hand it over
+                # on its own
+                pass
+        return self.mail.transport.send(message)
 
     def __exit__(self, exc_type, exc_value, tb):
-        pass
+        self._entered = False
+        if self._pending is not None:
+            self.flush()
+            self._pending = None
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            for conn in self._workers:
+                conn.__exit__(exc_type, exc_value, tb)
+            self._workers = []
+
+        if self.channel is not None:
+            self._close(self.channel)
+            self.channel = None
 
     def send_message(self, *args, **kwargs):
         """
@@ -35,4 +273,26 @@ class Connection(object):
         Takes same arguments as Message constructor.
         """
 
-        self.send(Message(*args, **kwargs))
+        return self.send(Message(*args, **kwargs))
+
+
+def retry_delay(mail, result):
+    """
+    Returns the seconds to wait before handing a message over again, or
+    None if the delivery described by result is not to be retried.  Only
+    messages that reached none of their recipients are retried.
+
+    Delays double from **MAIL_RETRY_BACKOFF** up to
+    **MAIL_RETRY_MAX_BACKOFF**, with some jitter so that senders failing
+    together do not retry together.
+
+    :param mail: Mail instance
+    :param result: DeliveryResult of the last attempt
+    """
+
+    if (result.returncode not in mail.retry_codes or result.partial
+            or result.attempts > mail.retries):
+        return None
+    delay = min(mail.retry_backoff * 2 ** (result.attempts - 1),
+                mail.retry_max_backoff)
+    return delay * random.uniform(0.5, 1.0)
@@ -0,0 +1,221 @@
+from base64 import b64encode
+import hashlib
+import re
+import time
+
+try:
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import padding, rsa
+    crypto_available = True
+except ImportError:
+    crypto_available = False
+
+from .message import RenderCache
+
+# fields signed unless **MAIL_DKIM_HEADERS** says otherwise
+DEFAULT_HEADERS = ('From', 'To', 'Cc', 'Subject', 'Reply-To', 'Date',
+                   'Message-ID', 'MIME-Version', 'Content-Type',
+                   'Content-Transfer-Encoding')
+
+_WSP = re.compile(br'[ \t]+')
+_LINE_END = re.compile(br' ?\r?\n')
+_TRAILING_LINES = re.compile(br'(?:\r\n)*\Z')
+_FIELD = re.compile(br'^(?=[^ \t])', re.M)
+
+
+def load_key(pem):
+    """
+    Loads an unencrypted PEM RSA private key, in PKCS#1 or PKCS#8 form.
+
+    :param pem: key as str or bytes
+    """
+
+    if isinstance(pem, str):
+        pem = pem.encode('ascii')
+    key = serialization.load_pem_private_key(pem, password=None)
+    if not isinstance(key, rsa.RSAPrivateKey):
+        raise ValueError("not an RSA private key")
+    return key
+
+
+def relaxed_header(field):
+    """
+    Returns a header field in relaxed canonical form (RFC 6376, 3.4.2).
+
+    :param field: ``b'Name: value'``, possibly folded, with or without
+                  the line ending
+    """
+
+    name, sep, value = field.partition(b':')
+    value = _WSP.sub(b' ', value.replace(b'\r', b'').replace(b'\n', b''))
+    return name.strip().lower() + b':' + value.strip(b' ') + b'\r\n'
+
+
+class BodyHash(object):
+    """
+    SHA-256 hash of a message body in relaxed canonical form (RFC 6376,
+    3.4.4), worked out in a single pass as the body is written.
+
+    :param fp: file object the body is passed on to, if any
+    """
+
+    def __init__(self, fp=None):
+        self.fp = fp
+        self._hash = hashlib.sha256()
+        self._line = b''
+        # empty lines held back until something follows them, as those
+        # at the end of the body are left out
+        self._blank = 0
+        self._started = False
+
+    def write(self, data):
+        if self.fp is not None:
+            self.fp.write(data)
+        lines = self._line + data
+        end = lines.rfind(b'\n') + 1
+        self._line = lines[end:]
+        if end:
+            self._update(lines[:end])
+        return len(data)
+
+    def _update(self, lines):
+        # whole lines only, so runs of whitespace never straddle a write
+        lines = _LINE_END.sub(b'\r\n', _WSP.sub(b' ', lines))
+        trailing = _TRAILING_LINES.search(lines).start()
+        if trailing:
+            if self._blank:
+                self._hash.update(b'\r\n' * self._blank)
+            self._hash.update(lines[:trailing])
+            self._started = True
+            self._blank = 0
+        self._blank += (len(lines) - trailing) // 2
+
+    def digest(self):
+        if self._line:
+            self._update(self._line + b'\n')
+            self._line = b''
+        if self._started:
+            # the line ending of the last line
+            self._hash.update(b'\r\n')
+            self._started = False
+        self._blank = 0
+        return self._hash.digest()
+
+
+class DKIMSigner(object):
+    """
+    Signs messages with DKIM, rsa-sha256 and relaxed/relaxed
+    canonicalization.
+
+    Signatures are made by the ``cryptography`` package.  The key is
+    loaded once.  Body hashes are cached by body, so the
+    copies of a message sent to many recipients hash their body once and
+    only the signature over their headers is worked out for each.
+
+    :param key: PEM RSA private key
+    :param domain: signing domain, ``d=``
+    :param selector: selector of the public key in DNS, ``s=``
+    :param headers: names of the header fields signed, where present
+    :param cache_size: number of body hashes kept
+    :param cache_bytes: total size of the bodies hashes are kept for
+    """
+
+    def __init__(self, key, domain, selector, headers=None, cache_size=128,
+                 cache_bytes=16 * 1024 * 1024):
+        self.key = load_key(key)
+        self.domain = domain
+        self.selector = selector
+        self.headers = tuple(name.lower().encode('ascii')
+                             for name in (headers or DEFAULT_HEADERS))
+        self.body_hashes = RenderCache(cache_size, cache_bytes)
+
+    def body_hash(self, body):
+        """
+        Returns the hash of a body, from the cache if it was seen before.
+
+        :param body: serialized body as bytes
+        """
+
+        digest = self.body_hashes.get(body)
+        if digest is None:
+            hasher = BodyHash()
+            hasher.write(body)
+            digest = hasher.digest()
+            # the body itself is the key
+            self.body_hashes.put(body, digest, len(body))
+        return digest
+
+    def hasher(self, fp=None):
+        """
+        Returns a BodyHash for a body written out in parts.
+
+        :param fp: file object the body is passed on to, if any
+        """
+
+        return BodyHash(fp)
+
+    def signature(self, headers, body_hash):
+        """
+        Returns the DKIM-Signature header field for a message.
+
+        :param headers: serialized header fields of the message
+        :param body_hash: digest returned by body_hash() or a hasher()
+        """
+
+        fields = {}
+        for field in _FIELD.split(headers):
+            name = field.partition(b':')[0].strip().lower()
+            if name in self.headers:
+                # the last instance is the one verifiers pick first
+                fields[name] = field
+        signed = [name for name in self.headers if name in fields]
+
+        value = ('v=1; a=rsa-sha256; c=relaxed/relaxed; d=%s; s=%s;\n'
+                 '\tt=%d; h=%s;\n\tbh=%s;\n\tb='
+                 % (self.domain, self.selector, time.time(),
+                    ':'.join(name.decode('ascii') for name in signed),
+                    b64encode(body_hash).decode('ascii')))
+        field = b'DKIM-Signature: ' + value.encode('ascii')
+        data = b''.join(relaxed_header(fields[name]) for name in signed)
+        # the signature field itself goes last, without its line ending
+        data += relaxed_header(field)[:-2]
+        signature = self.key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+        return field + b64encode(signature) + b'\n'
+
+
+def make_signer(config):
+    """
+    Creates the DKIMSigner configured by **MAIL_DKIM_KEY** or
+    **MAIL_DKIM_KEY_FILE**, or returns None if neither is set.
+
+    :param config: application config
+    """
+
+    key = config.get('MAIL_DKIM_KEY')
+    path = config.get('MAIL_DKIM_KEY_FILE')
+    if not key and not path:
+        return None
+    if not crypto_available:
+        raise RuntimeError("cryptography must be installed to sign messages "
+                           "with DKIM")
+    if not key:
+        with open(path, 'rb') as fp:
+            key = fp.read()
+
+    selector = config.get('MAIL_DKIM_SELECTOR')
+    domain = config.get('MAIL_DKIM_DOMAIN')
+    if not domain:
+        # the domain of the default sender, which the From header must
+        # belong to anyway
+        sender = config.get('DEFAULT_MAIL_SENDER') or ''
+        if isinstance(sender, tuple):
+            sender = sender[1]
+        domain = sender.rpartition('@')[2].rstrip('>').strip()
+    if not selector or not domain:
+        raise ValueError("MAIL_DKIM_SELECTOR and MAIL_DKIM_DOMAIN must be "
+                         "set to sign messages")
+    return DKIMSigner(key, domain, selector,
+                      config.get('MAIL_DKIM_HEADERS'),
+                      config.get('MAIL_DKIM_CACHE_SIZE', 128),
+                      config.get('MAIL_RENDER_CACHE_MAX_BYTES',
+                                 16 * 1024 * 1024))
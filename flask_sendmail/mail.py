@@ -1,5 +1,20 @@
-from .message import Message
+import atexit
+from contextlib import contextmanager
+
+from .message import Message, RenderCache, merge
+from .dkim import make_signer
+from .metrics import EX_OK, EX_TEMPFAIL, EX_UNAVAILABLE, DeliveryResult
 from .connection import Connection
+from .pool import ChannelPool
+from .transport import make_transport
+from .throttle import make_throttle
+from .zygote import make_zygote
+from .aio import AsyncConnection
+from .background import BackgroundSender
+from .spool import Spool, SpoolFlusher
+from .schedule import Dispatcher, ScheduleIndex, due_time
+from .templating import MessageTemplates
+from .signals import email_dispatched, signals_available
 
 
 class Mail(object):
@@ -20,24 +35,283 @@ class Mail(object):
         self.debug = app.config.get('MAIL_DEBUG', app.debug)
         self.mailer = app.config.get('MAIL_MAILER', '/usr/sbin/sendmail')
         self.mailer_flags = app.config.get('MAIL_MAILER_FLAGS', '-t')
-        self.suppress = app.config.get('MAIL_SUPPRESS_SEND', False)
+        self.suppress = app.config.get('MAIL_SUPPRESS_SEND', app.testing)
+        self.serialize_suppressed = app.config.get(
+            'MAIL_SERIALIZE_SUPPRESSED', False)
         self.fail_silently = app.config.get('MAIL_FAIL_SILENTLY', True)
-        self.max_emails = None
-        self.suppress = self.suppress or app.testing
+        self.retries = app.config.get('MAIL_RETRIES', 2)
+        self.retry_codes = frozenset(app.config.get(
+            'MAIL_RETRY_CODES', (EX_TEMPFAIL, EX_UNAVAILABLE)))
+        self.retry_backoff = app.config.get('MAIL_RETRY_BACKOFF', 0.1)
+        self.retry_max_backoff = app.config.get('MAIL_RETRY_MAX_BACKOFF', 2.0)
+        self.metrics = app.config.get('MAIL_METRICS_SINK')
+        self.max_emails = app.config.get('DEFAULT_MAX_EMAILS')
+        self.default_sender = app.config.get('DEFAULT_MAIL_SENDER')
         self.app = app
 
+        self.mailer_batch_flags = app.config.get('MAIL_MAILER_BATCH_FLAGS')
+        self.mailer_batch_timeout = app.config.get(
+            'MAIL_MAILER_BATCH_TIMEOUT', 5.0)
+        self.envelope_mode = app.config.get('MAIL_ENVELOPE_MODE', False)
+        self.mailer_envelope_flags = app.config.get(
+            'MAIL_MAILER_ENVELOPE_FLAGS', '-i')
+        self.envelope_max_recipients = app.config.get(
+            'MAIL_ENVELOPE_MAX_RECIPIENTS', 100)
+        self.coalesce = app.config.get('MAIL_COALESCE', False)
+        self.coalesce_max_recipients = app.config.get(
+            'MAIL_COALESCE_MAX_RECIPIENTS', 100)
+        self.coalesce_window = app.config.get('MAIL_COALESCE_WINDOW', 1000)
+        self.dkim = make_signer(app.config)
+        if getattr(self, 'zygote', None) is not None:
+            self.zygote.close()
+            atexit.unregister(self.zygote.close)
+        self.zygote = make_zygote(app.config)
+        self.transport = make_transport(self, app.config)
+        if getattr(self, 'throttle', None) is not None:
+            self.throttle.close()
+        self.throttle = make_throttle(app.config)
+        self.pool_size = app.config.get('MAIL_POOL_SIZE', 0)
+        self.delivery_concurrency = app.config.get(
+            'MAIL_DELIVERY_CONCURRENCY', 1)
+        if getattr(self, 'pool', None) is not None:
+            self.pool.close()
+            atexit.unregister(self.pool.close)
+        self.pool = None
+        if self.pool_size:
+            self.pool = ChannelPool(
+                self, self.pool_size, self.max_emails,
+                idle_timeout=app.config.get('MAIL_POOL_IDLE_TIMEOUT', 60.0),
+                check_interval=app.config.get('MAIL_POOL_CHECK_INTERVAL',
+                                              10.0),
+                timeout=app.config.get('MAIL_POOL_TIMEOUT', 10.0),
+                reserved=app.config.get('MAIL_POOL_CRITICAL_RESERVE', 1))
+            atexit.register(self.pool.close)
+
+        if getattr(self, 'background', None) is not None:
+            self.background.shutdown()
+            atexit.unregister(self.background.shutdown)
+        self.background = BackgroundSender(
+            self,
+            app.config.get('MAIL_BACKGROUND_THREADS', 4),
+            app.config.get('MAIL_BACKGROUND_QUEUE_SIZE', 100),
+            app.config.get('MAIL_BACKGROUND_CRITICAL_THREADS', 1),
+            app.config.get('MAIL_PRIORITY_WEIGHTS'))
+        atexit.register(self.background.shutdown)
+
+        if getattr(self, 'spool_flusher', None) is not None:
+            self.spool_flusher.stop()
+        self.spool = None
+        self.spool_flusher = None
+        spool_dir = app.config.get('MAIL_SPOOL_DIR')
+        if spool_dir:
+            self.spool = Spool(spool_dir,
+                               app.config.get('MAIL_SPOOL_FSYNC', True))
+            self.spool_flusher = SpoolFlusher(
+                self, self.spool,
+                interval=app.config.get('MAIL_SPOOL_INTERVAL', 1.0),
+                batch_size=app.config.get('MAIL_SPOOL_BATCH_SIZE', 100),
+                max_attempts=app.config.get('MAIL_SPOOL_MAX_ATTEMPTS', 10),
+                backoff=app.config.get('MAIL_SPOOL_BACKOFF', 30.0))
+            self.spool_autoflush = app.config.get('MAIL_SPOOL_FLUSHER', True)
+            if self.spool_autoflush:
+                self.spool_flusher.start()
+
+        if getattr(self, 'dispatcher', None) is not None:
+            self.dispatcher.stop()
+        self.schedule = None
+        self.dispatcher = None
+        schedule_db = app.config.get('MAIL_SCHEDULE_DB')
+        if schedule_db:
+            self.schedule = ScheduleIndex(schedule_db)
+            self.dispatcher = Dispatcher(
+                self, self.schedule,
+                interval=app.config.get('MAIL_SCHEDULE_INTERVAL', 1.0),
+                batch_size=app.config.get('MAIL_SCHEDULE_BATCH_SIZE', 100),
+                max_attempts=app.config.get('MAIL_SCHEDULE_MAX_ATTEMPTS', 10),
+                backoff=app.config.get('MAIL_SCHEDULE_BACKOFF', 30.0))
+            self.schedule_autodispatch = app.config.get(
+                'MAIL_SCHEDULE_DISPATCHER', True)
+            if self.schedule_autodispatch:
+                self.dispatcher.start()
+
+        self.templates = MessageTemplates(
+            app, app.config.get('MAIL_TEMPLATE_CACHE_STATIC', True))
+
+        self.render_cache = RenderCache(
+            app.config.get('MAIL_RENDER_CACHE_SIZE', 128),
+            app.config.get('MAIL_RENDER_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+
         #register extension with app
         app.extensions = getattr(app, 'extensions', {})
         app.extensions['sendmail'] = self
 
-    def send(self, message):
+    def send(self, message, at=None, delay=None):
         """
         Sends message through system's sendmail client.
 
+        Returns a DeliveryResult.  A spooled message counts as accepted,
+        as it does when sendmail queues it.
+
+        Given ``at`` or ``delay``, the message is stored in
+        **MAIL_SCHEDULE_DB** and sent once it is due instead, and a handle
+        for :meth:`cancel` is returned.
+
         :param message: Mail Message instance
+        :param at: ``datetime`` or Unix timestamp to send the message at;
+                   naive datetimes are in local time
+        :param delay: seconds or ``timedelta`` to wait before sending
+        """
+
+        message._bind(self)
+        if at is not None or delay is not None:
+            if self.schedule is None:
+                raise RuntimeError("MAIL_SCHEDULE_DB is not set")
+            message.verify()
+            handle = self.schedule.put(message, due_time(at, delay))
+            if self.schedule_autodispatch:
+                self.dispatcher.start()
+                self.dispatcher.wakeup()
+            return handle
+
+        if self.spool is not None and not self.suppress:
+            message.verify()
+            self.spool.put(message)
+            if self.spool_autoflush:
+                self.spool_flusher.start()
+                self.spool_flusher.wakeup()
+            return DeliveryResult(EX_OK)
+
+        return message.send(self.connect())
+
+    @contextmanager
+    def record_messages(self):
+        """
+        Records every message sent while the block runs, delivered or
+        suppressed::
+
+            with mail.record_messages() as outbox:
+                mail.send_message(subject="testing",
+                                  recipients=["to@example.com"],
+                                  body="testing")
+
+            assert outbox[0].subject == "testing"
+
+        Requires blinker.
         """
 
-        message.send(self.connect())
+        if not signals_available:
+            raise RuntimeError("blinker must be installed to record messages")
+
+        outbox = []
+
+        def _record(message, **extra):
+            outbox.append(message)
+
+        email_dispatched.connect(_record)
+        try:
+            yield outbox
+        finally:
+            email_dispatched.disconnect(_record)
+
+    def cancel(self, handle):
+        """
+        Cancels a scheduled message.
+
+        Returns False if the message was already sent, or is being sent.
+
+        :param handle: handle returned by send()
+        """
+
+        return self.schedule.cancel(handle)
+
+    def dispatch_scheduled(self):
+        """
+        Sends every scheduled message that is due, in the calling thread.
+
+        Returns the number of messages handed over.
+        """
+
+        return self.dispatcher.dispatch()
+
+    def flush_spool(self):
+        """
+        Delivers every spooled message that is due, in the calling thread.
+
+        Returns the number of messages handed over successfully.
+        """
+
+        return self.spool_flusher.flush()
+
+    async def send_async(self, message):
+        """
+        Sends message through system's sendmail client without blocking
+        the event loop.
+
+        :param message: Mail Message instance
+        """
+
+        return await message.send(AsyncConnection(self))
+
+    def send_background(self, message, timeout=None):
+        """
+        Hands message to a background thread and returns a
+        ``concurrent.futures.Future`` for its DeliveryResult.
+
+        Messages are sent by priority, see Message.  Blocks while
+        **MAIL_BACKGROUND_QUEUE_SIZE** messages of the same priority are
+        already waiting, raising QueueFull after ``timeout`` seconds if
+        given.
+
+        :param message: Mail Message instance
+        :param timeout: seconds to wait for room in the queue
+        """
+
+        message._bind(self)
+        message.verify()
+        return self.background.submit(message, timeout)
+
+    def send_many(self, message, recipients, context_fn=None):
+        """
+        Sends a copy of message to every recipient, through one connection.
+
+        Returns a DeliveryResult for every recipient, in their order.
+
+        :param message: Mail Message instance used as the template
+        :param recipients: iterable of addresses, consumed lazily
+        :param context_fn: callable returning a dict of ``$name``
+                           substitutions for a recipient
+        """
+
+        message._bind(self)
+        messages = merge(message, recipients, context_fn)
+        if self.spool is not None and not self.suppress:
+            return [self.send(msg) for msg in messages]
+
+        with self.connect() as conn:
+            results = [msg.send(conn) for msg in messages]
+        if conn.concurrency > 1 or conn.coalesce:
+            results = [future.result() for future in results]
+        return results
+
+    def render_message(self, template_name, **context):
+        """
+        Returns a Message whose body and HTML are rendered from the
+        templates ``template_name.txt`` and ``template_name.html``, either
+        of which may be missing.
+
+        The templates are looked up once and kept compiled.  Set the
+        subject and recipients of the message before sending it::
+
+            msg = mail.render_message('mail/welcome', user=user)
+            msg.subject = "Welcome"
+            msg.add_recipient(user.email)
+
+        :param template_name: template name, without suffix
+        :param context: template variables
+        """
+
+        body, html = self.templates.render(template_name, context)
+        return Message('', body=body, html=html)
 
     def send_message(self, *args, **kwargs):
         """
@@ -46,11 +320,25 @@ class Mail(object):
         Takes same arguments as Message constructor.
         """
 
-        self.send(Message(*args, **kwargs))
+        return self.send(Message(*args, **kwargs))
+
+    def connect(self, max_emails=None, concurrency=None, coalesce=None):
+        """
+        Opens a connection to the mailer.
+
+        :param max_emails: number of messages after which the mailer
+                           process is replaced
+        :param concurrency: number of mailer processes used at once,
+                            **MAIL_DELIVERY_CONCURRENCY** by default
+        :param coalesce: merge messages differing only in their Bcc
+                         recipients, **MAIL_COALESCE** by default
+        """
+
+        return Connection(self, max_emails, concurrency, coalesce)
 
-    def connect(self, max_emails=None):
+    def connect_async(self, max_emails=None):
         """
-        Opens a connection to the system's sendmail client.
+        Opens an asyncio connection to the mailer.
         """
 
-        return Connection(self, max_emails)
+        return AsyncConnection(self, max_emails)
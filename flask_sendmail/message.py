@@ -1,5 +1,21 @@
+from base64 import encodebytes
+from collections import OrderedDict, namedtuple
+from email.generator import BytesGenerator
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-import sys
+from email.policy import compat32
+from email.utils import formataddr, parseaddr
+from io import BytesIO
+from string import Template
+import copy
+import mimetypes
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
 
 try:
     from flask import _app_ctx_stack as stack
@@ -7,10 +23,312 @@ except ImportError:
     from flask import _request_ctx_stack as stack
 
 
+# read attachments in multiples of 57 bytes, which base64 encode to
+# whole 76 character lines
+ATTACHMENT_CHUNK_SIZE = 57 * 1024
+
+# bodies with attachments kept in memory while being signed, larger ones
+# going to a temporary file
+SIGNING_BUFFER_SIZE = 1024 * 1024
+
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses maxsize currsize')
+
+# header values and envelope recipients of a message, worked out once
+Addresses = namedtuple('Addresses', 'to cc bcc send_to')
+
+_SPECIAL = re.compile(r'[\s<>()",;:\\\[\]]')
+
+
 class BadHeaderError(Exception):
     pass
 
 
+class RenderCache(object):
+    """
+    Thread-safe LRU cache of encoded message bodies.
+
+    Entries are bounded in number and in total size, so that large or
+    personalized bodies do not pile up; an entry larger than ``maxbytes``
+    on its own is not kept at all.
+
+    :param maxsize: number of bodies kept, 0 disables the cache
+    :param maxbytes: total size of the bodies kept
+    """
+
+    def __init__(self, maxsize=128, maxbytes=16 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.currbytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0):
+        """
+        Keeps value under key.
+
+        :param size: bytes held by the entry, key included
+        """
+
+        with self._lock:
+            if not self.maxsize or size > self.maxbytes:
+                return
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.currbytes -= old[1]
+            self._data[key] = (value, size)
+            self.currbytes += size
+            self._evict()
+
+    def _evict(self):
+        while (len(self._data) > self.maxsize
+               or self.currbytes > self.maxbytes):
+            key, (value, size) = self._data.popitem(last=False)
+            self.currbytes -= size
+
+    def resize(self, maxsize, maxbytes=None):
+        with self._lock:
+            self.maxsize = maxsize
+            if maxbytes is not None:
+                self.maxbytes = maxbytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.currbytes = 0
+            self.hits = self.misses = 0
+
+    def info(self):
+        """
+        Returns a CacheInfo tuple, like functools.lru_cache.
+        """
+
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._data))
+
+
+def render_body(body, html, charset, cache=None):
+    """
+    Returns the encoded MIME part for a message body as a pair of bytes:
+    its content headers and its payload, which together with a blank line
+    in between make up the part.
+
+    Results are kept in cache, so messages sharing a body only encode it
+    once.
+
+    :param body: plain text message
+    :param html: HTML message
+    :param charset: used to set MIMEText _charset
+    :param cache: RenderCache of the Mail instance, if any
+    """
+
+    key = (body, html, charset)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+
+    result = _fast_body(body, html, charset)
+    if result is None:
+        result = _stdlib_body(body, html, charset)
+
+    if cache is not None:
+        cache.put(key, result, len(body or '') + len(html or '')
+                  + len(result[0]) + len(result[1]))
+    return result
+
+
+# The fast writer below produces the same bytes as the email package does
+# for the common cases -- text in us-ascii or utf-8, alone or as a
+# multipart/alternative pair -- without building a MIME tree and running
+# the generator over it.  Anything else goes through the email package.
+
+_NEWLINES = re.compile(r'\r\n|\r')
+_UNSAFE_HEADER = re.compile(r'[^\t\x20-\x7e]')
+_HEADER_POLICY = compat32.clone(max_line_length=0)
+
+
+def _fast_text(text, subtype, charset):
+    if charset is None:
+        charset = 'us-ascii' if text.isascii() else 'utf-8'
+    if charset == 'us-ascii' and text.isascii():
+        payload = _NEWLINES.sub('\n', text).encode('ascii')
+        encoding = b'7bit'
+    elif charset == 'utf-8':
+        try:
+            payload = encodebytes(text.encode('utf-8'))
+        except UnicodeEncodeError:
+            return None
+        encoding = b'base64'
+    else:
+        return None
+
+    head = (b'Content-Type: text/%s; charset="%s"\n'
+            b'MIME-Version: 1.0\n'
+            b'Content-Transfer-Encoding: %s\n'
+            % (subtype.encode('ascii'), charset.encode('ascii'), encoding))
+    return head, payload
+
+
+def _multipart_head(subtype, boundary):
+    return (b'Content-Type: multipart/%s; boundary="%s"\nMIME-Version: 1.0\n'
+            % (subtype.encode('ascii'), boundary.encode('ascii')))
+
+
+def _fast_body(body, html, charset):
+    if not (body and html):
+        return _fast_text(html or body, 'html' if html else 'plain', charset)
+
+    parts = [_fast_text(body, 'plain', charset),
+             _fast_text(html, 'html', charset)]
+    if None in parts:
+        return None
+
+    boundary = _make_boundary()
+    while any(boundary.encode('ascii') in part for head, part in parts):
+        boundary = _make_boundary()
+    delimiter = b'--' + boundary.encode('ascii')
+    payload = (delimiter + b'\n'
+               + (b'\n' + delimiter + b'\n').join(
+                   head + b'\n' + part for head, part in parts)
+               + b'\n' + delimiter + b'--\n')
+    return _multipart_head('alternative', boundary), payload
+
+
+def _stdlib_body(body, html, charset):
+    if body and html:
+        part = MIMEMultipart('alternative', _make_boundary())
+        part.attach(MIMEText(body, 'plain', charset))
+        part.attach(MIMEText(html, 'html', charset))
+    elif html:
+        part = MIMEText(html, 'html', charset)
+    else:
+        part = MIMEText(body, 'plain', charset)
+
+    fp = BytesIO()
+    _flatten(fp, part)
+    head, sep, payload = fp.getvalue().partition(b'\n\n')
+    return head + b'\n', payload
+
+
+def _write_header(fp, name, value):
+    if (isinstance(value, str) and len(value) < 900000
+            and not _UNSAFE_HEADER.search(value)):
+        # what Header.encode() makes of printable ASCII when not folding
+        fp.write(b'%s: %s\n' % (name.encode('ascii'), value.encode('ascii')))
+    else:
+        fp.write(_HEADER_POLICY.fold_binary(name, value))
+
+
+def _make_boundary():
+    return '=' * 15 + uuid.uuid4().hex + '=='
+
+
+class Attachment(object):
+    """
+    Encapsulates file attachment information.
+
+    The content is taken from ``data``, or read from ``path`` or ``fp``
+    in chunks while the message is being written, so large files are
+    never held in memory.
+
+    :param filename: filename of attachment
+    :param content_type: file mimetype, guessed from the filename if not given
+    :param data: the raw file data
+    :param disposition: content-disposition (if any)
+    :param headers: dict of extra headers
+    :param path: file to read the data from
+    :param fp: binary file object to read the data from
+    """
+
+    def __init__(self, filename=None, content_type=None, data=None,
+                 disposition=None, headers=None, path=None, fp=None):
+
+        if filename is None and path is not None:
+            filename = os.path.basename(path)
+        if content_type is None:
+            content_type = (filename and mimetypes.guess_type(filename)[0]
+                            or 'application/octet-stream')
+
+        self.filename = filename
+        self.content_type = content_type
+        self.data = data
+        self.disposition = disposition or 'attachment'
+        self.headers = headers or {}
+        self.path = path
+        self.fp = fp
+        self.offset = None
+        if fp is not None and fp.seekable():
+            self.offset = fp.tell()
+
+    def open(self):
+        """
+        Returns a binary file object positioned at the start of the content.
+        """
+
+        if self.path is not None:
+            return open(self.path, 'rb')
+        if self.fp is not None:
+            if self.offset is not None:
+                self.fp.seek(self.offset)
+            return _Unclosable(self.fp)
+        data = self.data
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return BytesIO(data or b'')
+
+    def headers_part(self):
+        """
+        Returns a MIME part carrying the attachment headers only.
+        """
+
+        part = MIMEBase(*self.content_type.split('/', 1))
+        part['Content-Transfer-Encoding'] = 'base64'
+        if self.filename:
+            try:
+                self.filename.encode('ascii')
+                filename = self.filename
+            except UnicodeEncodeError:
+                filename = ('UTF8', '', self.filename)
+            part.add_header('Content-Disposition', self.disposition,
+                            filename=filename)
+        else:
+            part.add_header('Content-Disposition', self.disposition)
+        for key, value in self.headers.items():
+            part[key] = value
+        part.set_payload('')
+        return part
+
+    def write_to(self, fp):
+        """
+        Writes the attachment as a base64 encoded MIME part.
+
+        :param fp: binary file object to write to
+        """
+
+        _flatten(fp, self.headers_part())
+        with self.open() as src:
+            while True:
+                chunk = src.read(ATTACHMENT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                fp.write(encodebytes(chunk))
+
+
 class Message(object):
     """
     Encapsulates an email message.
@@ -25,35 +343,111 @@ class Message(object):
     :param attachments: list of Attachment instances
     :param reply_to: reply-to address
     :param charset: used to set MIMEText _charset
+    :param priority: ``'critical'``, ``'normal'`` or ``'bulk'``, deciding
+                     which messages send_background() sends first
     """
 
+    __slots__ = ('subject', '_sender', 'body', 'html', 'charset', 'cc', 'bcc',
+                 'reply_to', 'recipients', 'attachments', 'priority',
+                 '_address_cache', '_signer', '_render_cache')
+
     def __init__(self, subject, recipients=None, body=None, html=None,
                 sender=None, cc=None, bcc=None, attachments=None,
-                reply_to=None, charset=None):
-
-        if sender is None:
-            app = stack.top.app
-            sender = app.config.get("DEFAULT_MAIL_SENDER")
+                reply_to=None, charset=None, priority='normal'):
 
         self.subject = subject
-        self.sender = sender
+        # DEFAULT_MAIL_SENDER is looked up when the message is sent, so
+        # messages can be built outside of an application context
+        self._sender = sender
         self.body = body
         self.html = html
         self.charset = charset
         self.cc = cc
         self.bcc = bcc
         self.reply_to = reply_to
-
-        if recipients is None:
-            recipients = []
-
-        self.recipients = list(recipients)
+        self.recipients = list(recipients) if recipients else []
+        self.priority = priority
+        self._address_cache = None
+        self._signer = None
+        self._render_cache = None
 
         if attachments is None:
             attachments = []
 
         self.attachments = attachments
 
+    @property
+    def sender(self):
+        """
+        Sender address, or **DEFAULT_MAIL_SENDER** if none was given.
+        """
+
+        if self._sender is None:
+            return _default_sender()
+        return self._sender
+
+    @sender.setter
+    def sender(self, value):
+        self._sender = value
+
+    def _bind(self, mail):
+        # fills in the defaults of the Mail instance sending the message
+        if self._sender is None:
+            self._sender = mail.default_sender
+        self._signer = mail.dkim
+        self._render_cache = mail.render_cache
+
+    @property
+    def send_to(self):
+        """
+        Set of addresses the message is delivered to, including Cc and Bcc.
+        """
+
+        return self.addresses().send_to
+
+    @property
+    def envelope_sender(self):
+        """
+        Bare address of the sender, as used in the SMTP envelope.
+        """
+
+        return _address(_format_address(self.sender))
+
+    def addresses(self):
+        """
+        Returns the To, Cc and Bcc header values and the envelope
+        recipients of the message.
+
+        ``(name, address)`` tuples are formatted, domain names are
+        IDNA-encoded and addresses appearing more than once are kept only
+        in the first of To, Cc and Bcc.  The result is cached until the
+        recipients change.
+        """
+
+        key = (tuple(self.recipients), _address_list(self.cc),
+               _address_list(self.bcc))
+        cached = self._address_cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        seen = set()
+        headers = []
+        for values in key:
+            formatted = []
+            for value in values:
+                value = _format_address(value)
+                address = _address(value)
+                if address in seen:
+                    continue
+                seen.add(address)
+                formatted.append(value)
+            headers.append(', '.join(formatted))
+
+        result = Addresses(headers[0], headers[1], headers[2],
+                           frozenset(seen))
+        self._address_cache = (key, result)
+        return result
+
     def add_recipient(self, recipient):
         """
         Adds another recipient to the message.
@@ -65,53 +459,131 @@ class Message(object):
 
     def is_bad_headers(self):
         """
-        Checks for bad headers i.e. newlines in subject, sender or recipients.
+        Checks for bad headers i.e. newlines in subject, sender, reply-to
+        or any of the To, Cc and Bcc addresses.
+        """
+
+        addresses = self.addresses()
+        values = [self.subject, _format_address(self.sender),
+                  _format_address(self.reply_to),
+                  addresses.to, addresses.cc, addresses.bcc]
+        # substring tests are far quicker than a regex over long lists
+        return any('\n' in v or '\r' in v for v in values if v)
+
+    def attach(self, filename=None, content_type=None, data=None,
+               disposition=None, headers=None, path=None, fp=None):
+        """
+        Adds an attachment to the message.
+
+        Takes same arguments as Attachment constructor.
+        """
+
+        self.attachments.append(Attachment(filename, content_type, data,
+                                           disposition, headers, path, fp))
+
+    def write_to(self, fp, include_bcc=True):
+        """
+        Serializes the message straight into a binary file object, such
+        as the mailer's stdin, without building it in memory first.
+
+        Messages sent through a Mail instance with **MAIL_DKIM_KEY** set
+        are signed.
+
+        :param fp: file object to write to
+        :param include_bcc: write the Bcc header, for mailers which strip it
+                            themselves (``sendmail -t``)
         """
 
-        reply_to = self.reply_to or ''
-        for val in [self.subject, self.sender, reply_to] + self.recipients:
-            for c in '\r\n':
-                if c in val:
-                    return True
-        return False
+        cache = self._render_cache
+        if cache is None:
+            # not handed to a Mail instance yet, as by dump()
+            mail = _current_mail()
+            cache = mail.render_cache if mail is not None else None
+        head, payload = render_body(self.body, self.html, self.charset, cache)
+        boundary = _make_boundary() if self.attachments else None
+
+        signer = self._signer
+        if signer is None:
+            self._write_headers(fp, head, boundary, include_bcc)
+            self._write_body(fp, head, payload, boundary)
+            return
 
-    def dump(self):
-        if self.html:
-            msg = MIMEText(self.html, 'html', self.charset)
-        elif self.body:
-            msg = MIMEText(self.body, 'plain', self.charset)
+        headers = BytesIO()
+        self._write_headers(headers, head, boundary, include_bcc)
+        headers = headers.getvalue()
+        if boundary is None:
+            # the body is shared by every copy of the message, and so is
+            # its hash
+            fp.write(signer.signature(headers, signer.body_hash(payload)))
+            fp.write(headers)
+            fp.write(payload)
+            return
+
+        # the signature goes before the body it covers, which is hashed
+        # while it is set aside
+        with tempfile.SpooledTemporaryFile(SIGNING_BUFFER_SIZE) as body:
+            hasher = signer.hasher(body)
+            self._write_body(hasher, head, payload, boundary)
+            fp.write(signer.signature(headers, hasher.digest()))
+            fp.write(headers)
+            body.seek(0)
+            shutil.copyfileobj(body, fp)
+
+    def _write_headers(self, fp, head, boundary, include_bcc):
+        if boundary is not None:
+            fp.write(_multipart_head('mixed', boundary))
+        else:
+            # the message headers go between the body's content headers
+            # and its payload
+            fp.write(head)
 
         if isinstance(self.sender, tuple):
             # sender can be tuple of (name, address)
-            self.sender = "%s <%s>" % self.sender
-
-        msg['Subject'] = self.subject
-        msg['To'] = ', '.join(self.recipients)
-        msg['From'] = self.sender
-        if self.cc:
-            if hasattr(self.cc, '__iter__'):
-                msg['Cc'] = ', '.join(self.cc)
-            else:
-                msg['Cc'] = self.cc
-        if self.bcc:
-            if hasattr(self.bcc, '__iter__'):
-                msg['Bcc'] = ', '.join(self.bcc)
-            else:
-                msg['Bcc'] = self.bcc
+            self.sender = _format_address(self.sender)
+
+        addresses = self.addresses()
+        _write_header(fp, 'Subject', self.subject)
+        _write_header(fp, 'To', addresses.to)
+        _write_header(fp, 'From', _format_address(self.sender))
+        if addresses.cc:
+            _write_header(fp, 'Cc', addresses.cc)
+        if addresses.bcc and include_bcc:
+            _write_header(fp, 'Bcc', addresses.bcc)
         if self.reply_to:
-            msg['Reply-To'] = self.reply_to
+            _write_header(fp, 'Reply-To', _format_address(self.reply_to))
+        fp.write(b'\n')
 
-        msg_str = msg.as_string()
-        if sys.version_info >= (3,0) and isinstance(msg_str, str):
-            return msg_str.encode(self.charset or 'utf-8')
-        else:
-            return msg_str
+    def _write_body(self, fp, head, payload, boundary):
+        if boundary is None:
+            fp.write(payload)
+            return
 
-    def send(self, connection):
+        # attachments are streamed into the multipart/mixed container one
+        # by one rather than built into the MIME tree, laid out exactly as
+        # the generator would
+        delimiter = b'--' + boundary.encode('ascii')
+        fp.write(delimiter + b'\n')
+        fp.write(head + b'\n' + payload)
+        for attachment in self.attachments:
+            fp.write(b'\n' + delimiter + b'\n')
+            attachment.write_to(fp)
+        fp.write(b'\n' + delimiter + b'--\n')
+
+    def dump(self, include_bcc=True):
         """
-        Verifies and sends the message.
+        Serializes the message to bytes.
 
-        :param connection: Connection instance
+        :param include_bcc: write the Bcc header, for mailers which strip it
+                            themselves (``sendmail -t``)
+        """
+
+        fp = BytesIO()
+        self.write_to(fp, include_bcc)
+        return fp.getvalue()
+
+    def verify(self):
+        """
+        Verifies the message is complete and free of header injection.
         """
 
         assert self.recipients, "No recipients have been added"
@@ -121,4 +593,125 @@ class Message(object):
         if self.is_bad_headers():
             raise BadHeaderError
 
-        connection.send(self)
+    def send(self, connection):
+        """
+        Verifies and sends the message, returning its DeliveryResult.
+
+        :param connection: Connection instance
+        """
+
+        self._bind(connection.mail)
+        self.verify()
+        return connection.send(self)
+
+
+def merge(message, recipients, context_fn=None):
+    """
+    Yields a copy of message for every recipient, for mail merges.
+
+    If context_fn is given, ``$name`` placeholders in the subject, body
+    and HTML are substituted from the mapping it returns for each
+    recipient; the templates are compiled once for the whole run.
+    Without it the copies share the body, which is then only encoded once.
+
+    :param message: Message used as the template
+    :param recipients: iterable of addresses, consumed lazily
+    :param context_fn: callable returning substitutions for a recipient
+    """
+
+    fields = (message.subject, message.body, message.html)
+    if context_fn is not None:
+        templates = [Template(value) if value else None for value in fields]
+
+    for recipient in recipients:
+        msg = copy.copy(message)
+        msg.recipients = [recipient]
+        if context_fn is not None:
+            context = context_fn(recipient)
+            msg.subject, msg.body, msg.html = [
+                template.safe_substitute(context) if template else value
+                for template, value in zip(templates, fields)]
+        yield msg
+
+
+class _Unclosable(object):
+    # lets a caller's file object be used in a with block without closing it
+
+    def __init__(self, fp):
+        self.read = fp.read
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+
+def _flatten(fp, msg):
+    # same options as Message.as_string()
+    BytesGenerator(fp, mangle_from_=False, maxheaderlen=0).flatten(msg)
+
+
+def _default_sender():
+    # DEFAULT_MAIL_SENDER of the application in context, if any
+    top = stack.top
+    if top is None:
+        return None
+    mail = top.app.extensions.get('sendmail')
+    if mail is not None:
+        return mail.default_sender
+    return top.app.config.get('DEFAULT_MAIL_SENDER')
+
+
+def _current_mail():
+    # Mail instance of the application in context, if any
+    top = stack.top
+    if top is None:
+        return None
+    return top.app.extensions.get('sendmail')
+
+
+def _address_list(value):
+    # cc and bcc may be a single address or any sequence of them, whose
+    # items may be (name, address) tuples
+    if not value:
+        return ()
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+def _format_address(value):
+    # formats (name, address) tuples and IDNA-encodes the domain name,
+    # leaving anything else alone
+    if isinstance(value, tuple):
+        name, address = value
+        return formataddr((name, _idna(address)))
+    if not value or value.isascii():
+        return value
+    name, address = parseaddr(value)
+    encoded = _idna(address)
+    if encoded == address:
+        return value
+    return formataddr((name, encoded))
+
+
+def _address(value):
+    if isinstance(value, tuple):
+        return _idna(value[1])
+    if not value:
+        return value
+    if not _SPECIAL.search(value):
+        # a bare address, which is by far the most common case
+        return _idna(value)
+    return _idna(parseaddr(value)[1])
+
+
+def _idna(address):
+    local, sep, domain = address.rpartition('@')
+    if not sep or domain.isascii():
+        return address
+    try:
+        return '%s@%s' % (local, domain.encode('idna').decode('ascii'))
+    except UnicodeError:
+        return address
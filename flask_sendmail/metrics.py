@@ -0,0 +1,218 @@
+from time import perf_counter
+
+from .signals import email_dispatched, signals_available
+
+# exit codes from sysexits.h, as returned by sendmail
+EX_OK = 0
+EX_USAGE = 64
+EX_DATAERR = 65
+EX_NOINPUT = 66
+EX_NOUSER = 67
+EX_NOHOST = 68
+EX_UNAVAILABLE = 69
+EX_SOFTWARE = 70
+EX_OSERR = 71
+EX_OSFILE = 72
+EX_CANTCREAT = 73
+EX_IOERR = 74
+EX_TEMPFAIL = 75
+EX_PROTOCOL = 76
+EX_NOPERM = 77
+EX_CONFIG = 78
+
+SYSEXITS = {
+    EX_OK: ('EX_OK', 'successful termination'),
+    EX_USAGE: ('EX_USAGE', 'command line usage error'),
+    EX_DATAERR: ('EX_DATAERR', 'data format error'),
+    EX_NOINPUT: ('EX_NOINPUT', 'cannot open input'),
+    EX_NOUSER: ('EX_NOUSER', 'addressee unknown'),
+    EX_NOHOST: ('EX_NOHOST', 'host name unknown'),
+    EX_UNAVAILABLE: ('EX_UNAVAILABLE', 'service unavailable'),
+    EX_SOFTWARE: ('EX_SOFTWARE', 'internal software error'),
+    EX_OSERR: ('EX_OSERR', 'system error'),
+    EX_OSFILE: ('EX_OSFILE', 'critical OS file missing'),
+    EX_CANTCREAT: ('EX_CANTCREAT', "can't create output file"),
+    EX_IOERR: ('EX_IOERR', 'input/output error'),
+    EX_TEMPFAIL: ('EX_TEMPFAIL', 'temporary failure'),
+    EX_PROTOCOL: ('EX_PROTOCOL', 'remote error in protocol'),
+    EX_NOPERM: ('EX_NOPERM', 'permission denied'),
+    EX_CONFIG: ('EX_CONFIG', 'configuration error'),
+}
+
+
+class DeliveryError(Exception):
+    """
+    Raised by send() when a message could not be delivered and
+    **MAIL_FAIL_SILENTLY** is off.
+
+    :param result: DeliveryResult of the last attempt
+    """
+
+    def __init__(self, result):
+        self.result = result
+        message = '%s (%s)' % (result.reason, result.status)
+        stderr = result.stderr.decode('utf-8', 'replace').strip()
+        if stderr:
+            message += ': ' + stderr
+        super(DeliveryError, self).__init__(message)
+
+
+class DeliveryResult(object):
+    """
+    Outcome and timings of handing one message to the mailer.
+
+    All times are in seconds.
+
+    :param returncode: sendmail return code
+    :param serialize: time spent serializing the message
+    :param spawn: time spent starting the mailer process
+    :param write: time spent writing to the mailer's stdin
+    :param wait: time spent waiting for the mailer to answer
+    :param bytes: number of bytes written to the mailer
+    :param stderr: error output of the mailer, or the SMTP reply that
+                   rejected the message in batch mode
+    :param attempts: number of times the message was handed over,
+                     retries included
+    :param partial: whether some recipients got the message although
+                    the delivery failed, in which case it is not retried
+    """
+
+    def __init__(self, returncode=None, serialize=0.0, spawn=0.0, write=0.0,
+                 wait=0.0, bytes=0, stderr=b'', attempts=1, partial=False):
+        self.returncode = returncode
+        self.serialize = serialize
+        self.spawn = spawn
+        self.write = write
+        self.wait = wait
+        self.bytes = bytes
+        self.stderr = stderr
+        self.attempts = attempts
+        self.partial = partial
+
+    @property
+    def duration(self):
+        return self.serialize + self.spawn + self.write + self.wait
+
+    @property
+    def ok(self):
+        return self.returncode == EX_OK
+
+    @property
+    def status(self):
+        """
+        Name of the return code in sysexits.h, such as ``EX_TEMPFAIL``.
+        """
+
+        return SYSEXITS.get(self.returncode, ('EX_%s' % self.returncode,))[0]
+
+    @property
+    def reason(self):
+        """
+        Meaning of the return code, such as ``temporary failure``.
+        """
+
+        if self.returncode in SYSEXITS:
+            return SYSEXITS[self.returncode][1]
+        return 'mailer exited with %s' % self.returncode
+
+    def __repr__(self):
+        return ('<DeliveryResult %s duration=%.6f bytes=%d attempts=%d>'
+                % (self.status, self.duration, self.bytes, self.attempts))
+
+
+class MeteredWriter(object):
+    """
+    File-like wrapper counting the bytes written and the time it takes.
+
+    :param write: callable receiving the bytes
+    """
+
+    def __init__(self, write):
+        self._write = write
+        self.elapsed = 0.0
+        self.bytes = 0
+
+    def write(self, data):
+        start = perf_counter()
+        self._write(data)
+        self.elapsed += perf_counter() - start
+        self.bytes += len(data)
+
+
+class MetricsSink(object):
+    """
+    Receives delivery metrics.
+
+    Subclass it to feed StatsD, Prometheus or similar, and set an instance
+    as **MAIL_METRICS_SINK**.  The default implementation does nothing.
+    """
+
+    def timing(self, name, seconds):
+        """
+        Records a duration.
+
+        :param name: metric name, such as ``mail.wait``
+        :param seconds: duration in seconds
+        """
+
+    def incr(self, name, value=1):
+        """
+        Increments a counter.
+
+        :param name: metric name, such as ``mail.bytes``
+        :param value: amount to add
+        """
+
+
+def record(mail, message, result):
+    """
+    Reports a delivery to the metrics sink and email_dispatched receivers.
+
+    :param mail: Mail instance
+    :param message: message that was delivered
+    :param result: DeliveryResult instance
+    """
+
+    sink = mail.metrics
+    if sink is not None:
+        sink.timing('mail.serialize', result.serialize)
+        sink.timing('mail.spawn', result.spawn)
+        sink.timing('mail.write', result.write)
+        sink.timing('mail.wait', result.wait)
+        sink.incr('mail.bytes', result.bytes)
+        sink.incr('mail.sent' if result.returncode == 0 else 'mail.failed')
+        sink.incr('mail.returncode.%s' % result.returncode)
+        if result.attempts > 1:
+            sink.incr('mail.retries', result.attempts - 1)
+
+    if signals_available and email_dispatched.receivers:
+        email_dispatched.send(message, app=mail.app, result=result)
+
+
+def record_suppressed(mail, message):
+    """
+    Stands in for a delivery while sending is suppressed: nothing is
+    handed to the mailer, and the message is serialized only if
+    **MAIL_SERIALIZE_SUPPRESSED** asks for it.
+
+    Returns the DeliveryResult sent to email_dispatched receivers.
+
+    :param mail: Mail instance
+    :param message: message that would have been delivered
+    """
+
+    result = DeliveryResult(EX_OK)
+    if mail.serialize_suppressed:
+        start = perf_counter()
+        writer = MeteredWriter(_discard)
+        message.write_to(writer)
+        result.serialize = perf_counter() - start
+        result.bytes = writer.bytes
+
+    if signals_available and email_dispatched.receivers:
+        email_dispatched.send(message, app=mail.app, result=result)
+    return result
+
+
+def _discard(data):
+    pass
@@ -0,0 +1,188 @@
+import os
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+from .channel import ChannelError
+
+
+class ChannelPool(object):
+    """
+    Bounded pool of long-lived mailer channels shared by a Mail instance.
+
+    Channels are opened on demand through the mail transport, reused across
+    sends and recycled once they have delivered ``max_emails`` messages.
+    Channels left idle for ``idle_timeout`` seconds are closed rather than
+    reused, and those idle for ``check_interval`` seconds are checked to
+    still answer before they are handed out.
+
+    When every channel is in use, acquire() waits up to ``timeout`` seconds
+    for one to be released, and does not wait at all in a thread that
+    already holds one, which would never be released meanwhile.
+
+    ``reserved`` of the channels are kept for critical messages, so that
+    bulk sending never takes the whole pool.
+
+    :param mail: Mail instance
+    :param size: maximum number of channels open at once
+    :param max_emails: number of messages after which a channel is recycled
+    :param idle_timeout: seconds after which an idle channel is closed
+    :param check_interval: seconds of idleness after which a channel is
+                           checked before reuse
+    :param timeout: seconds to wait for a channel when all are in use
+    :param reserved: number of channels only handed out for critical
+                     messages, at most ``size - 1``
+    """
+
+    def __init__(self, mail, size, max_emails=None, idle_timeout=None,
+                 check_interval=None, timeout=None, reserved=0):
+        self.mail = mail
+        self.size = size
+        self.reserved = max(0, min(reserved, size - 1))
+        self.max_emails = max_emails
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self._cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._open = 0
+        # thread holding each channel handed out, by channel id
+        self._holders = {}
+
+    @property
+    def shared(self):
+        """
+        Number of channels handed out for messages that are not critical.
+        """
+
+        return self.size - self.reserved
+
+    def acquire(self, critical=False):
+        """
+        Returns an idle channel, opening a new one if the pool is not full
+        and waiting for one to be released otherwise.
+
+        Raises ChannelError if a new channel cannot be opened, or if none
+        is released in time.
+
+        :param critical: the channel is for a critical message, which may
+                         use the reserved channels
+        """
+
+        while True:
+            channel = self._take(critical)
+            if channel is None:
+                break
+            if self._usable(channel):
+                return self._hand_out(channel)
+            channel.close()
+            self._discard()
+
+        try:
+            return self._hand_out(self.mail.transport.open())
+        except Exception:
+            self._discard()
+            raise
+
+    def _hand_out(self, channel):
+        with self._cond:
+            self._holders[id(channel)] = threading.get_ident()
+        return channel
+
+    def _take(self, critical):
+        # returns an idle channel, or None once a slot for a new one has
+        # been reserved
+        limit = self.size if critical else self.shared
+        deadline = None
+        if self.timeout is not None:
+            deadline = monotonic() + self.timeout
+        with self._cond:
+            if self._pid != os.getpid():
+                # forked: the channels belong to the parent process
+                self._reset()
+            while True:
+                # channels in use, which only critical messages may take
+                # the reserved ones beyond
+                if self._open - len(self._idle) < limit:
+                    while self._idle:
+                        channel = self._idle.pop()
+                        if channel.alive:
+                            return channel
+                        self._open -= 1
+                    if self._open < self.size:
+                        self._open += 1
+                        return None
+                if threading.get_ident() in self._holders.values():
+                    raise ChannelError("every pooled channel is in use, "
+                                       "some by this thread")
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise ChannelError("no pooled channel released "
+                                           "within %s seconds" % self.timeout)
+                self._cond.wait(remaining)
+
+    def _usable(self, channel):
+        idle = monotonic() - channel.last_used
+        if self.idle_timeout is not None and idle > self.idle_timeout:
+            return False
+        if self.check_interval is not None and idle > self.check_interval:
+            return channel.ping()
+        return True
+
+    def _discard(self):
+        with self._cond:
+            self._open -= 1
+            # waiters may be held to different limits
+            self._cond.notify_all()
+
+    def release(self, channel):
+        """
+        Returns a channel to the pool, closing it if it is worn out.
+
+        :param channel: channel obtained from acquire()
+        """
+
+        with self._cond:
+            if channel.pid != self._pid:
+                return
+            self._holders.pop(id(channel), None)
+            recycle = not channel.alive or (
+                self.max_emails and channel.sent >= self.max_emails)
+            if recycle:
+                self._open -= 1
+            else:
+                self._idle.append(channel)
+            self._cond.notify_all()
+
+        if recycle:
+            channel.close()
+
+    @contextmanager
+    def channel(self, critical=False):
+        channel = self.acquire(critical)
+        try:
+            yield channel
+        finally:
+            self.release(channel)
+
+    def close(self):
+        """
+        Closes all idle channels.
+        """
+
+        with self._cond:
+            if self._pid != os.getpid():
+                self._reset()
+                return
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+            self._cond.notify_all()
+
+        for channel in idle:
+            channel.close()
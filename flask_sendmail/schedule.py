@@ -0,0 +1,364 @@
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from io import BytesIO
+
+from .spool import _alive, _copy_headers_without_bcc
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scheduled (
+    id INTEGER PRIMARY KEY,
+    handle TEXT NOT NULL UNIQUE,
+    due REAL NOT NULL,
+    claimed INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    sender TEXT,
+    recipients TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scheduled_due ON scheduled (claimed, due);
+'''
+
+# claimed by no process: the message was given up on
+FAILED = -1
+
+
+class StoredMessage(object):
+    """
+    Message read back from the schedule index.
+
+    Provides the parts of the Message interface used by the delivery
+    channels and the spool.
+
+    :param sender: envelope sender
+    :param recipients: envelope recipients
+    :param data: the message, Bcc header included
+    """
+
+    def __init__(self, sender, recipients, data):
+        self.envelope_sender = sender
+        self.send_to = set(recipients)
+        self.data = data
+
+    def _bind(self, mail):
+        # the sender was filled in before the message was scheduled
+        pass
+
+    def verify(self):
+        pass
+
+    def write_to(self, fp, include_bcc=True):
+        src = BytesIO(self.data)
+        if not include_bcc:
+            _copy_headers_without_bcc(src, fp)
+        shutil.copyfileobj(src, fp)
+
+    def dump(self, include_bcc=True):
+        fp = BytesIO()
+        self.write_to(fp, include_bcc)
+        return fp.getvalue()
+
+
+class ScheduleIndex(object):
+    """
+    Persistent index of messages waiting to be sent at a given time,
+    kept in a SQLite database.
+
+    Due messages are found through an index on their due time, so taking
+    them out does not depend on how many are waiting.  Several processes
+    may share the database; each message is claimed by one of them.
+    Messages given up on stay in the database, claimed by FAILED.
+
+    :param path: database file, created if missing
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections belong to the thread that opened them
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30.0,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def put(self, message, due):
+        """
+        Stores a message to be sent at due, a Unix timestamp, and
+        returns its handle.
+
+        :param message: Message instance
+        :param due: time to send the message at
+        """
+
+        handle = uuid.uuid4().hex
+        self._connection().execute(
+            'INSERT INTO scheduled (handle, due, sender, recipients, data) '
+            'VALUES (?, ?, ?, ?, ?)',
+            (handle, due, message.envelope_sender,
+             json.dumps(sorted(message.send_to)), message.dump()))
+        return handle
+
+    def cancel(self, handle):
+        """
+        Removes a message that has not been taken out for sending yet.
+
+        Returns whether the message was removed.
+
+        :param handle: handle returned by put()
+        """
+
+        cursor = self._connection().execute(
+            'DELETE FROM scheduled WHERE handle = ? AND claimed = 0',
+            (handle,))
+        return cursor.rowcount > 0
+
+    def next_due(self):
+        """
+        Returns the due time of the earliest message, or None.
+        """
+
+        row = self._connection().execute(
+            'SELECT MIN(due) FROM scheduled WHERE claimed = 0').fetchone()
+        return row[0]
+
+    def claim(self, limit, now=None):
+        """
+        Claims messages that are due, for this process.
+
+        Returns (id, attempts, StoredMessage) tuples, attempts being the
+        number of failed tries so far.
+
+        :param limit: maximum number of messages to claim
+        :param now: timestamp the messages must be due by
+        """
+
+        if now is None:
+            now = time.time()
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            rows = db.execute(
+                'SELECT id, attempts, sender, recipients, data '
+                'FROM scheduled '
+                'WHERE claimed = 0 AND due <= ? ORDER BY due LIMIT ?',
+                (now, limit)).fetchall()
+            db.executemany('UPDATE scheduled SET claimed = ? WHERE id = ?',
+                           [(os.getpid(), row[0]) for row in rows])
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return [(id, attempts,
+                 StoredMessage(sender, json.loads(recipients), data))
+                for id, attempts, sender, recipients, data in rows]
+
+    def done(self, ids):
+        self._connection().executemany(
+            'DELETE FROM scheduled WHERE id = ?', [(id,) for id in ids])
+
+    def defer(self, id, attempts, due):
+        """
+        Releases a claimed message, to be tried again at due.
+
+        :param id: id returned by claim()
+        :param attempts: number of failed tries so far
+        :param due: time to try again at
+        """
+
+        self._connection().execute(
+            'UPDATE scheduled SET claimed = 0, attempts = ?, due = ? '
+            'WHERE id = ?', (attempts, due, id))
+
+    def fail(self, id):
+        """
+        Gives up on a claimed message, which is kept but never sent.
+        """
+
+        self._connection().execute(
+            'UPDATE scheduled SET claimed = ? WHERE id = ?', (FAILED, id))
+
+    def recover(self):
+        """
+        Releases messages claimed by processes which no longer exist.
+        """
+
+        db = self._connection()
+        pids = [row[0] for row in db.execute(
+            'SELECT DISTINCT claimed FROM scheduled WHERE claimed > 0')]
+        for pid in pids:
+            if pid != os.getpid() and not _alive(pid):
+                db.execute('UPDATE scheduled SET claimed = 0 '
+                           'WHERE claimed = ?', (pid,))
+
+    def __len__(self):
+        # messages still to be sent
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM scheduled WHERE claimed != ?',
+            (FAILED,)).fetchone()[0]
+
+
+class Dispatcher(object):
+    """
+    Sends scheduled messages once they are due, from a background
+    thread.
+
+    Due messages are sent in batches through one connection, or put in
+    the spool if there is one, and removed from the index once the mailer
+    or the spool accepted them.  A message the mailer does not accept is
+    retried with exponential backoff, and given up on after
+    ``max_attempts`` tries.  The thread sleeps until the earliest message
+    is due, checking at least every ``interval`` seconds for messages
+    scheduled by other processes.
+
+    :param mail: Mail instance
+    :param index: ScheduleIndex instance
+    :param interval: longest time between checks of the index
+    :param batch_size: messages sent per connection
+    :param max_attempts: number of tries before a message is given up on
+    :param backoff: delay before the first retry, doubled on every attempt
+    :param max_backoff: longest delay between retries
+    """
+
+    def __init__(self, mail, index, interval=1.0, batch_size=100,
+                 max_attempts=10, backoff=30.0, max_backoff=3600.0):
+        self.mail = mail
+        self.index = index
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def dispatch(self, now=None):
+        """
+        Sends every message that is due.
+
+        Returns the number of messages handed over successfully.
+
+        :param now: timestamp the messages must be due by
+        """
+
+        if now is None:
+            now = time.time()
+        self.index.recover()
+        handed = 0
+        while True:
+            # messages deferred meanwhile are due after now
+            batch = self.index.claim(self.batch_size, now)
+            if not batch:
+                return handed
+
+            spool = self.mail.spool
+            if spool is not None and not self.mail.suppress:
+                for id, attempts, message in batch:
+                    spool.put(message)
+                    # the spool retries it from now on
+                    self.index.done([id])
+                    handed += 1
+                if self.mail.spool_autoflush:
+                    self.mail.spool_flusher.start()
+                    self.mail.spool_flusher.wakeup()
+                continue
+
+            results = []
+            with self.mail.connect() as conn:
+                for id, attempts, message in batch:
+                    try:
+                        status = conn.send(message)
+                    except Exception:
+                        status = None
+                    results.append((id, attempts, status))
+
+            for id, attempts, status in results:
+                if isinstance(status, Future):
+                    try:
+                        status = status.result()
+                    except Exception:
+                        status = None
+                if status is not None and status.ok:
+                    self.index.done([id])
+                    handed += 1
+                elif attempts + 1 >= self.max_attempts:
+                    self.index.fail(id)
+                else:
+                    delay = min(self.backoff * 2 ** attempts,
+                                self.max_backoff)
+                    self.index.defer(id, attempts + 1, time.time() + delay)
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def start(self):
+        """
+        Starts the background thread, if it is not already running in
+        this process.
+        """
+
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='flask-sendmail-schedule')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            wait = self.interval
+            try:
+                self.dispatch()
+                due = self.index.next_due()
+                if due is not None:
+                    wait = min(wait, max(0.0, due - time.time()))
+            except Exception:
+                # keep the dispatcher alive; messages stay in the index
+                pass
+            self._wakeup.wait(wait)
+
+
+def due_time(at=None, delay=None):
+    """
+    Returns the Unix timestamp a message is to be sent at.
+
+    :param at: ``datetime``, naive ones being in local time, or a Unix
+               timestamp
+    :param delay: seconds or ``timedelta`` from now, added to ``at`` if
+                  both are given
+    """
+
+    if isinstance(at, datetime.datetime):
+        due = at.timestamp()
+    elif at is None:
+        due = time.time()
+    else:
+        due = float(at)
+    if isinstance(delay, datetime.timedelta):
+        delay = delay.total_seconds()
+    return due + (delay or 0)
@@ -0,0 +1,16 @@
+try:
+    from blinker import Namespace
+    signals_available = True
+except ImportError:
+    # signals without receivers, which cannot be connected to
+    from flask.signals import Namespace
+    signals_available = False
+
+signals = Namespace()
+
+email_dispatched = signals.signal("email-dispatched", doc="""
+Signal sent after a message has been handed to the mailer.
+
+The signal is sent with the message as its sender, plus the application
+as ``app`` and a DeliveryResult describing the delivery as ``result``.
+""")
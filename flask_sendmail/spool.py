@@ -0,0 +1,297 @@
+import errno
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from io import BytesIO
+
+# maildir-style layout: messages are written to tmp/, renamed into new/
+# when complete, claimed by renaming into cur/ while being delivered and
+# moved to defer/ to wait for a retry or failed/ once we give up
+SUBDIRS = ('tmp', 'new', 'cur', 'defer', 'failed')
+
+
+class SpooledMessage(object):
+    """
+    Message read back from the spool.
+
+    Provides the parts of the Message interface used by the delivery
+    channels; the message itself stays on disk until it is written out.
+
+    :param path: spool file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            envelope = json.loads(fp.readline().decode('utf-8'))
+            self.offset = fp.tell()
+        self.envelope_sender = envelope['sender']
+        self.send_to = set(envelope['recipients'])
+
+    def _bind(self, mail):
+        # the sender was filled in before the message was spooled
+        pass
+
+    def write_to(self, fp, include_bcc=True):
+        with open(self.path, 'rb') as src:
+            src.seek(self.offset)
+            if not include_bcc:
+                _copy_headers_without_bcc(src, fp)
+            shutil.copyfileobj(src, fp)
+
+    def dump(self, include_bcc=True):
+        fp = BytesIO()
+        self.write_to(fp, include_bcc)
+        return fp.getvalue()
+
+
+class Spool(object):
+    """
+    Durable on-disk queue of outgoing messages.
+
+    :param directory: spool directory, created if missing
+    :param fsync: flush messages to disk before accepting them
+    """
+
+    def __init__(self, directory, fsync=True):
+        self.directory = directory
+        self.fsync = fsync
+        self._counter = 0
+        self._lock = threading.Lock()
+        for name in SUBDIRS:
+            path = os.path.join(directory, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _path(self, subdir, name):
+        return os.path.join(self.directory, subdir, name)
+
+    def _unique(self):
+        with self._lock:
+            self._counter += 1
+            counter = self._counter
+        hostname = socket.gethostname()
+        for c in '/:,':
+            hostname = hostname.replace(c, '_')
+        return '%.6f.P%dQ%d.%s' % (time.time(), os.getpid(), counter,
+                                   hostname)
+
+    def put(self, message):
+        """
+        Writes a message to the spool and returns its name.
+
+        :param message: Message instance
+        """
+
+        envelope = {'sender': message.envelope_sender,
+                    'recipients': sorted(message.send_to)}
+        name = self._unique()
+        tmp = self._path('tmp', name)
+        with open(tmp, 'wb') as fp:
+            fp.write(json.dumps(envelope).encode('utf-8') + b'\n')
+            message.write_to(fp)
+            if self.fsync:
+                fp.flush()
+                os.fsync(fp.fileno())
+        os.rename(tmp, self._path('new', name))
+        return name
+
+    def __len__(self):
+        return sum(len(os.listdir(self._path(subdir, '')))
+                   for subdir in ('new', 'cur', 'defer'))
+
+    def claim(self, limit=None, now=None):
+        """
+        Claims messages that are due for delivery, moving them to cur/.
+
+        Returns (name, attempts, path) tuples.
+
+        :param limit: maximum number of messages to claim
+        :param now: timestamp deferred messages must be due by
+        """
+
+        if now is None:
+            now = time.time()
+        candidates = [(name, 0) for name in os.listdir(self._path('new', ''))]
+        for entry in os.listdir(self._path('defer', '')):
+            name, attempts, not_before = entry.rsplit(',', 2)
+            if float(not_before) <= now:
+                candidates.append((entry, int(attempts)))
+
+        claimed = []
+        for entry, attempts in sorted(candidates):
+            if limit is not None and len(claimed) >= limit:
+                break
+            src = self._path('new' if not attempts else 'defer', entry)
+            name = entry.split(',', 1)[0]
+            dst = self._path('cur', '%s,%d,%d' % (name, attempts, os.getpid()))
+            try:
+                os.rename(src, dst)
+            except OSError:
+                # claimed by another flusher
+                continue
+            claimed.append((name, attempts, dst))
+        return claimed
+
+    def done(self, path):
+        os.unlink(path)
+
+    def defer(self, name, attempts, path, delay):
+        os.rename(path, self._path(
+            'defer', '%s,%d,%.6f' % (name, attempts, time.time() + delay)))
+
+    def fail(self, name, path):
+        os.rename(path, self._path('failed', name))
+
+    def recover(self):
+        """
+        Returns messages claimed by processes which no longer exist to new/.
+        """
+
+        for entry in os.listdir(self._path('cur', '')):
+            name, attempts, pid = entry.rsplit(',', 2)
+            if int(pid) == os.getpid() or _alive(int(pid)):
+                continue
+            if int(attempts):
+                dst = self._path('defer', '%s,%s,0' % (name, attempts))
+            else:
+                dst = self._path('new', name)
+            try:
+                os.rename(self._path('cur', entry), dst)
+            except OSError:
+                pass
+
+
+class SpoolFlusher(object):
+    """
+    Drains a spool into the mailer from a background thread.
+
+    Messages are sent in batches through one connection.  A message the
+    mailer does not accept is retried with exponential backoff, and moved
+    to the spool's failed/ directory after ``max_attempts`` tries.
+
+    :param mail: Mail instance
+    :param spool: Spool instance
+    :param interval: seconds between checks of the spool
+    :param batch_size: messages sent per connection
+    :param max_attempts: number of tries before a message is given up on
+    :param backoff: delay before the first retry, doubled on every attempt
+    :param max_backoff: longest delay between retries
+    """
+
+    def __init__(self, mail, spool, interval=1.0, batch_size=100,
+                 max_attempts=10, backoff=30.0, max_backoff=3600.0):
+        self.mail = mail
+        self.spool = spool
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def flush(self):
+        """
+        Delivers every message that is currently due.
+
+        Returns the number of messages handed over successfully.
+        """
+
+        self.spool.recover()
+        now = time.time()
+        delivered = 0
+        while True:
+            batch = self.spool.claim(self.batch_size, now)
+            if not batch:
+                return delivered
+            results = []
+            with self.mail.connect() as conn:
+                for name, attempts, path in batch:
+                    try:
+                        status = conn.send(SpooledMessage(path))
+                    except Exception:
+                        status = None
+                    results.append((name, attempts, path, status))
+
+            for name, attempts, path, status in results:
+                if isinstance(status, Future):
+                    try:
+                        status = status.result()
+                    except Exception:
+                        status = None
+                if status is not None and status.ok:
+                    self.spool.done(path)
+                    delivered += 1
+                elif attempts + 1 >= self.max_attempts:
+                    self.spool.fail(name, path)
+                else:
+                    delay = min(self.backoff * 2 ** attempts,
+                                self.max_backoff)
+                    self.spool.defer(name, attempts + 1, path, delay)
+
+    def wakeup(self):
+        self._wakeup.set()
+
+    def start(self):
+        """
+        Starts the background thread, if it is not already running in
+        this process.
+        """
+
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='flask-sendmail-spool')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                # keep the flusher alive; failures are retried next round
+                pass
+            self._wakeup.wait(self.interval)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _copy_headers_without_bcc(src, fp):
+    # copies the header block, up to and including the blank line that
+    # ends it, leaving out Bcc and its continuation lines
+    skipping = False
+    for line in src:
+        if line[:1] in (b' ', b'\t'):
+            if not skipping:
+                fp.write(line)
+            continue
+        skipping = line[:4].lower() == b'bcc:'
+        if not skipping:
+            fp.write(line)
+        if line in (b'\n', b'\r\n'):
+            return
@@ -0,0 +1,117 @@
+import threading
+
+from flask import before_render_template, has_app_context, \
+    template_rendered
+from jinja2 import TemplateNotFound, TemplatesNotFound, meta
+
+# template suffixes of the plain text and HTML bodies
+SUFFIXES = ('.txt', '.html')
+
+
+class MessageTemplates(object):
+    """
+    Templates of message bodies, looked up in the application's Jinja
+    environment once and kept compiled.
+
+    A message template ``name`` is a pair of ``name.txt`` and
+    ``name.html`` templates, one of which may be missing.  Templates that
+    read nothing from their context render the same every time; with
+    ``cache_static`` their output is kept too, and shared by every message
+    that uses them.
+
+    :param app: Flask application instance
+    :param cache_static: keep the output of templates which do not depend
+                         on their context
+    """
+
+    def __init__(self, app, cache_static=True):
+        self.app = app
+        self.cache_static = cache_static
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def _load(self, name):
+        env = self.app.jinja_env
+        if env.auto_reload:
+            # templates are being edited; let Jinja check them for changes
+            return self._resolve(env, name)
+        sections = self._templates.get(name)
+        if sections is None:
+            sections = self._resolve(env, name)
+            with self._lock:
+                self._templates[name] = sections
+        return sections
+
+    def _resolve(self, env, name):
+        sections = []
+        for suffix in SUFFIXES:
+            try:
+                template = env.get_template(name + suffix)
+            except TemplateNotFound:
+                sections.append(None)
+                continue
+            output = None
+            if (self.cache_static and not env.auto_reload
+                    and _is_static(env, template.name)):
+                output = template.render()
+            sections.append((template, output))
+        if sections == [None, None]:
+            raise TemplatesNotFound([name + suffix for suffix in SUFFIXES])
+        return sections
+
+    def render(self, name, context):
+        """
+        Returns the plain text and HTML bodies rendered from the templates
+        of name, None for a missing one.
+
+        As with ``render_template``, the context is completed by the
+        application's context processors.
+
+        :param name: template name, without suffix
+        :param context: template variables
+        """
+
+        sections = self._load(name)
+        if all(section is None or section[1] is not None
+               for section in sections):
+            return tuple(section and section[1] for section in sections)
+
+        context = dict(context)
+        if has_app_context():
+            self.app.update_template_context(context)
+        bodies = []
+        for section in sections:
+            if section is None:
+                bodies.append(None)
+                continue
+            template, output = section
+            if output is None:
+                before_render_template.send(self.app, template=template,
+                                            context=context)
+                output = template.render(context)
+                template_rendered.send(self.app, template=template,
+                                       context=context)
+            bodies.append(output)
+        return tuple(bodies)
+
+    def clear(self):
+        with self._lock:
+            self._templates.clear()
+
+
+def _is_static(env, name, seen=()):
+    # whether a template and those it includes, imports or extends look
+    # up no variables at all
+    try:
+        source = env.loader.get_source(env, name)[0]
+    except TemplateNotFound:
+        return False
+    ast = env.parse(source)
+    if meta.find_undeclared_variables(ast):
+        return False
+    for referenced in meta.find_referenced_templates(ast):
+        if referenced is None or referenced in seen:
+            return False
+        if not _is_static(env, referenced, seen + (name,)):
+            return False
+    return True
@@ -0,0 +1,225 @@
+import fcntl
+import os
+import struct
+import threading
+import time
+from urllib.parse import quote
+
+# tokens left and the time they were counted, as stored by
+# SharedTokenBucket
+STATE = struct.Struct('<dd')
+
+# per-domain buckets kept before the idle ones are dropped
+MAX_DOMAINS = 1024
+
+
+class TokenBucket(object):
+    """
+    Token bucket shared by the threads of a process.
+
+    Tokens are added at ``rate`` per second, up to ``burst``.  Each
+    message takes one, and messages finding the bucket empty wait until
+    their token has been added.
+
+    :param rate: tokens added per second
+    :param burst: tokens the bucket holds
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens, stamp, now):
+        # the bucket may go negative: tokens are handed out in order and
+        # later takers wait for the earlier ones too
+        tokens = min(self.burst, tokens + (now - stamp) * self.rate) - 1
+        return tokens, max(0.0, -tokens / self.rate)
+
+    def reserve(self):
+        """
+        Takes a token and returns the seconds to wait before using it.
+        """
+
+        with self._lock:
+            now = time.monotonic()
+            self.tokens, delay = self._take(self.tokens, self.stamp, now)
+            self.stamp = now
+            return delay
+
+    def idle(self):
+        """
+        Whether the bucket is full again, so that dropping it changes
+        nothing.
+        """
+
+        with self._lock:
+            return (self.tokens + (time.monotonic() - self.stamp) * self.rate
+                    >= self.burst)
+
+    def close(self):
+        pass
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket shared by every process using the same file.
+
+    The state lives in ``path`` and is updated under an exclusive lock,
+    so processes on one host draw from a single bucket.
+
+    :param path: state file, created if needed
+    :param rate: tokens added per second
+    :param burst: tokens the bucket holds
+    """
+
+    def __init__(self, path, rate, burst):
+        super(SharedTokenBucket, self).__init__(rate, burst)
+        self.path = path
+        self._fd = None
+        self._pid = None
+
+    def _open(self):
+        # the lock belongs to the open file, which a forked child must
+        # not share with its parent
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            self._pid = os.getpid()
+        return self._fd
+
+    def reserve(self):
+        with self._lock:
+            fd = self._open()
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                data = os.pread(fd, STATE.size, 0)
+                if len(data) == STATE.size:
+                    tokens, stamp = STATE.unpack(data)
+                else:
+                    tokens, stamp = self.burst, now
+                tokens, delay = self._take(tokens, stamp, now)
+                os.pwrite(fd, STATE.pack(tokens, now), 0)
+                return delay
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def idle(self):
+        # the state is kept in the file
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._fd is not None and self._pid == os.getpid():
+                os.close(self._fd)
+            self._fd = None
+            self._pid = None
+
+
+class Throttle(object):
+    """
+    Limits the rate at which messages are handed to the mailer, overall
+    and for each recipient domain.
+
+    With a ``directory`` the buckets are kept in files there and shared
+    by every process using it; otherwise they are shared by the threads of
+    the process.
+
+    :param rate: messages per second, or None for no overall limit
+    :param burst: messages sent at once before the rate applies
+    :param domain_rate: messages per second to any one recipient domain,
+                        or None for no limit per domain
+    :param domain_burst: burst allowed for each domain
+    :param directory: directory holding the state of the buckets
+    """
+
+    def __init__(self, rate=None, burst=None, domain_rate=None,
+                 domain_burst=None, directory=None):
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.bucket = None
+        if rate:
+            self.bucket = self._bucket('all', rate, burst)
+        self.domain_rate = domain_rate
+        self.domain_burst = domain_burst
+        self._domains = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, name, rate, burst):
+        # a second's worth of messages by default
+        burst = burst or max(1, rate)
+        if self.directory is None:
+            return TokenBucket(rate, burst)
+        return SharedTokenBucket(
+            os.path.join(self.directory, quote(name, safe='@.-') + '.bucket'),
+            rate, burst)
+
+    def _domain(self, domain):
+        with self._lock:
+            bucket = self._domains.get(domain)
+            if bucket is None:
+                if len(self._domains) >= MAX_DOMAINS:
+                    for name, old in list(self._domains.items()):
+                        if old.idle():
+                            old.close()
+                            del self._domains[name]
+                bucket = self._domains[domain] = self._bucket(
+                    '@' + domain, self.domain_rate, self.domain_burst)
+            return bucket
+
+    def reserve(self, message):
+        """
+        Takes the tokens needed to send message and returns the seconds
+        to wait before handing it over.
+
+        :param message: Message instance
+        """
+
+        delay = 0.0
+        if self.bucket is not None:
+            delay = self.bucket.reserve()
+        if self.domain_rate:
+            domains = set(address.rpartition('@')[2].lower()
+                          for address in message.send_to)
+            for domain in domains:
+                delay = max(delay, self._domain(domain).reserve())
+        return delay
+
+    def wait(self, message):
+        """
+        Blocks until message may be handed over.
+
+        :param message: Message instance
+        """
+
+        delay = self.reserve(message)
+        if delay:
+            time.sleep(delay)
+
+    def close(self):
+        if self.bucket is not None:
+            self.bucket.close()
+        with self._lock:
+            for bucket in self._domains.values():
+                bucket.close()
+            self._domains.clear()
+
+
+def make_throttle(config):
+    """
+    Creates the Throttle configured by **MAIL_MAX_RATE** and
+    **MAIL_MAX_RATE_PER_DOMAIN**, or returns None if neither is set.
+
+    :param config: application config
+    """
+
+    rate = config.get('MAIL_MAX_RATE')
+    domain_rate = config.get('MAIL_MAX_RATE_PER_DOMAIN')
+    if not rate and not domain_rate:
+        return None
+    return Throttle(rate, config.get('MAIL_MAX_BURST'), domain_rate,
+                    config.get('MAIL_MAX_BURST_PER_DOMAIN'),
+                    config.get('MAIL_RATE_STATE_DIR'))
@@ -0,0 +1,164 @@
+import asyncio
+
+from .aio import AsyncExecChannel, AsyncThreadChannel
+from .channel import EX_TEMPFAIL, BatchChannel, ChannelError, ExecChannel, \
+    SMTPChannel
+from .metrics import DeliveryResult
+
+
+class SendmailTransport(object):
+    """
+    Hands messages to the system's sendmail client.
+
+    With **MAIL_MAILER_BATCH_FLAGS** set, channels run the mailer in
+    batch mode and fall back to spawning it once per message if it cannot,
+    after which batch mode is not tried again.  Otherwise the mailer is
+    spawned for every message.
+
+    :param mail: Mail instance
+    """
+
+    def __init__(self, mail):
+        self.mail = mail
+        self.batch = bool(mail.mailer_batch_flags)
+
+    def open(self):
+        """
+        Opens a channel for sending many messages.
+        """
+
+        if self.batch:
+            try:
+                return BatchChannel(self.mail)
+            except ChannelError:
+                self.batch = False
+        return ExecChannel(self.mail)
+
+    def send(self, message):
+        """
+        Sends a single message and returns its DeliveryResult.
+
+        :param message: Message instance
+        """
+
+        return ExecChannel(self.mail).send(message)
+
+    async def open_async(self):
+        if self.batch:
+            # batch sessions are driven from the default executor, with
+            # the same protocol code as open()
+            loop = asyncio.get_running_loop()
+            try:
+                return AsyncThreadChannel(
+                    await loop.run_in_executor(None, BatchChannel, self.mail))
+            except ChannelError:
+                self.batch = False
+        return AsyncExecChannel(self.mail)
+
+    async def send_async(self, message):
+        return await AsyncExecChannel(self.mail).send(message)
+
+
+class SMTPTransport(object):
+    """
+    Hands messages to an SMTP or LMTP server instead of the sendmail
+    client.
+
+    Together with **MAIL_POOL_SIZE**, sessions stay open and are reused
+    across requests.  Return codes follow sendmail's: a server that cannot
+    be reached gives ``EX_TEMPFAIL`` (75).
+
+    :param mail: Mail instance
+    :param host: server name or address, or path of a unix socket
+    :param port: server port, 25 for SMTP and 24 for LMTP by default
+    :param lmtp: speak LMTP instead of SMTP
+    :param username: user to authenticate as, if any
+    :param password: password of the user
+    :param starttls: upgrade connections with ``STARTTLS``
+    :param use_ssl: connect over TLS from the start
+    :param ssl_context: ``ssl.SSLContext`` used for TLS
+    :param timeout: socket timeout in seconds
+    """
+
+    def __init__(self, mail, host='localhost', port=None, lmtp=False,
+                 username=None, password=None, starttls=False, use_ssl=False,
+                 ssl_context=None, timeout=30.0):
+        self.mail = mail
+        self.host = host
+        self.port = port or (24 if lmtp else 25)
+        self.lmtp = lmtp
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.use_ssl = use_ssl
+        self.ssl_context = ssl_context
+        self.timeout = timeout
+
+    def open(self):
+        """
+        Opens a session for sending many messages.
+
+        Raises ChannelError if the server cannot be reached.
+        """
+
+        return SMTPChannel(self.mail, self.host, self.port, self.lmtp,
+                           self.username, self.password, self.starttls,
+                           self.use_ssl, self.ssl_context, self.timeout)
+
+    def send(self, message):
+        """
+        Sends a single message through a session of its own and returns
+        its DeliveryResult.
+
+        :param message: Message instance
+        """
+
+        try:
+            channel = self.open()
+            try:
+                return channel.send(message)
+            finally:
+                channel.close()
+        except ChannelError as e:
+            return DeliveryResult(EX_TEMPFAIL, stderr=str(e).encode())
+
+    async def open_async(self):
+        # sessions are driven from the default executor
+        loop = asyncio.get_running_loop()
+        return AsyncThreadChannel(await loop.run_in_executor(None, self.open))
+
+    async def send_async(self, message):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.send, message)
+
+
+def make_transport(mail, config):
+    """
+    Creates the transport named by **MAIL_TRANSPORT**.
+
+    The setting is one of ``'sendmail'``, ``'smtp'`` and ``'lmtp'``, or a
+    callable taking the Mail instance and returning a transport.
+
+    :param mail: Mail instance
+    :param config: application config
+    """
+
+    name = config.get('MAIL_TRANSPORT', 'sendmail')
+    if callable(name):
+        return name(mail)
+    if name == 'sendmail':
+        return SendmailTransport(mail)
+    if name not in ('smtp', 'lmtp'):
+        raise ValueError("unknown MAIL_TRANSPORT %r" % name)
+
+    return SMTPTransport(
+        mail,
+        host=config.get('MAIL_SMTP_HOST', 'localhost'),
+        port=config.get('MAIL_SMTP_PORT'),
+        lmtp=name == 'lmtp',
+        username=config.get('MAIL_SMTP_USERNAME'),
+        password=config.get('MAIL_SMTP_PASSWORD'),
+        starttls=config.get('MAIL_SMTP_STARTTLS', False),
+        use_ssl=config.get('MAIL_SMTP_SSL', False),
+        ssl_context=config.get('MAIL_SMTP_SSL_CONTEXT'),
+        timeout=config.get('MAIL_SMTP_TIMEOUT', 30.0))
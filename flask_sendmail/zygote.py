@@ -0,0 +1,352 @@
+# Small helper process running the mailer on behalf of large web workers,
+# so that they do not fork themselves for every message.  The helper runs
+# this file as a script and must import nothing but the standard library.
+
+import atexit
+import fcntl
+import json
+import os
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+from subprocess import DEVNULL, PIPE, Popen
+from time import perf_counter
+
+# length of the JSON header, which is followed by the message in chunks
+REQUEST = struct.Struct('!I')
+# length of a chunk of the message; an empty chunk ends it
+CHUNK = struct.Struct('!I')
+# length of the JSON answer
+REPLY = struct.Struct('!I')
+
+# largest chunk of a message sent to the helper
+CHUNK_SIZE = 64 * 1024
+
+
+class ZygoteError(Exception):
+    pass
+
+
+class Zygote(object):
+    """
+    Handle on the helper process, shared by the threads and forked
+    children of the process that started it.
+
+    The helper is started straight away and started again by whichever
+    process finds it gone.  It only runs the mailer it was started with,
+    and its socket is only accessible to the user running it.
+
+    :param mailer: path of the mailer, the only program the helper runs
+    :param directory: directory for the socket, a private temporary one
+                      by default
+    """
+
+    def __init__(self, mailer, directory=None):
+        self.mailer = mailer
+        self._owns_directory = directory is None
+        self.directory = directory or tempfile.mkdtemp(
+            prefix='flask-sendmail-')
+        self.path = os.path.join(self.directory, 'zygote.sock')
+        self.process = None
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self.start()
+
+    def start(self):
+        """
+        Starts a new helper, replacing the socket of the previous one.
+        """
+
+        process = Popen([sys.executable, os.path.abspath(__file__),
+                         self.path, self.mailer], stdin=PIPE, stdout=PIPE,
+                        close_fds=True)
+        if process.stdout.readline() != b'ready\n':
+            process.kill()
+            process.wait()
+            raise ZygoteError("mail helper failed to start")
+        self.process = process
+
+    def _respawn(self):
+        # several processes may find the helper gone at once; the first
+        # to get the lock starts a new one and the others use it
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                return self._connect()
+            except OSError:
+                self.start()
+                return self._connect()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _socket(self):
+        # one connection per thread, opened again after a fork
+        sock = getattr(self._local, 'socket', None)
+        if sock is not None and self._local.pid == os.getpid():
+            return sock
+        try:
+            sock = self._connect()
+        except OSError:
+            sock = self._respawn()
+        self._local.socket = sock
+        self._local.pid = os.getpid()
+        return sock
+
+    def _drop(self):
+        sock = getattr(self._local, 'socket', None)
+        if sock is not None and self._local.pid == os.getpid():
+            sock.close()
+        self._local.socket = None
+
+    def run(self, argv, source, include_bcc=True):
+        """
+        Runs the mailer in the helper, streaming a message to its stdin as
+        it is serialized, so that it is never held in memory as a whole.
+
+        Returns ``(returncode, stderr, spawn, wait, size)``: spawn and
+        wait are the seconds spent starting the mailer and waiting for it,
+        and size is the number of bytes written.
+
+        Raises ZygoteError if the helper could not be reached, in which
+        case the mailer was not run.  If the helper goes away after the
+        whole message was sent the mailer may have run, and an I/O error
+        is reported instead.
+
+        :param argv: command line of the mailer
+        :param source: message, or anything else with its write_to()
+        :param include_bcc: passed on to write_to()
+        """
+
+        header = json.dumps(argv).encode('utf-8')
+        for attempt in range(2):
+            try:
+                sock = self._socket()
+                sock.sendall(REQUEST.pack(len(header)) + header)
+                writer = _ChunkWriter(sock)
+                source.write_to(writer, include_bcc)
+                writer.close()
+                break
+            except OSError:
+                # the helper kills the mailer of a request cut short, so
+                # it is never run; a helper that died since the last
+                # message is started again
+                self._drop()
+            except BaseException:
+                self._drop()
+                raise
+        else:
+            raise ZygoteError("mail helper unavailable")
+
+        try:
+            size, = REPLY.unpack(_read(sock, REPLY.size))
+            reply = json.loads(_read(sock, size).decode('utf-8'))
+        except (OSError, EOFError) as e:
+            self._drop()
+            # EX_IOERR: the message may or may not have been queued
+            return 74, str(e).encode(), 0.0, 0.0, writer.bytes
+        return (reply['returncode'], reply['stderr'].encode('latin-1'),
+                reply['spawn'], reply['wait'], writer.bytes)
+
+    def close(self):
+        """
+        Stops the helper, if this process started it.
+        """
+
+        self._drop()
+        if self._pid != os.getpid():
+            return
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+        if self._owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def make_zygote(config):
+    """
+    Starts the helper if **MAIL_ZYGOTE** is set, or returns None.
+
+    :param config: application config
+    """
+
+    if not config.get('MAIL_ZYGOTE', False):
+        return None
+    zygote = Zygote(config.get('MAIL_MAILER', '/usr/sbin/sendmail'),
+                    config.get('MAIL_ZYGOTE_DIR'))
+    atexit.register(zygote.close)
+    return zygote
+
+
+class _ChunkWriter(object):
+    # file-like object sending what is written to it to the helper, in
+    # chunks of at most CHUNK_SIZE bytes
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.bytes = 0
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self.bytes += len(data)
+        view = memoryview(data)
+        if self._buffer:
+            take = CHUNK_SIZE - len(self._buffer)
+            self._buffer += view[:take]
+            view = view[take:]
+            if len(self._buffer) < CHUNK_SIZE:
+                return
+            self._send(self._buffer)
+            self._buffer = bytearray()
+        while len(view) >= CHUNK_SIZE:
+            self._send(view[:CHUNK_SIZE])
+            view = view[CHUNK_SIZE:]
+        self._buffer += view
+
+    def _send(self, chunk):
+        self.sock.sendall(CHUNK.pack(len(chunk)))
+        self.sock.sendall(chunk)
+
+    def close(self):
+        if self._buffer:
+            self._send(self._buffer)
+            self._buffer = bytearray()
+        self.sock.sendall(CHUNK.pack(0))
+
+
+def _read(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError("mail helper closed the connection")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _handle(conn, mailer):
+    with conn:
+        while True:
+            try:
+                size, = REQUEST.unpack(_read(conn, REQUEST.size))
+                argv = json.loads(_read(conn, size).decode('utf-8'))
+                reply = _run(conn, argv, mailer)
+            except (OSError, EOFError):
+                # the other end went away, possibly in the middle of a
+                # message, whose mailer was killed
+                return
+            reply = json.dumps(reply).encode('utf-8')
+            conn.sendall(REPLY.pack(len(reply)) + reply)
+
+
+def _run(conn, argv, mailer):
+    # runs the mailer on the message read from conn as it arrives
+    start = perf_counter()
+    if not argv or argv[0] != mailer:
+        _copy(conn, None)
+        # EX_NOPERM: nothing but the mailer is ever run
+        return _reply(77, ("mail helper only runs %s" % mailer).encode())
+    try:
+        process = Popen(argv, stdin=PIPE, stdout=DEVNULL, stderr=PIPE)
+    except OSError as e:
+        _copy(conn, None)
+        # EX_UNAVAILABLE, as a shell would report a missing mailer
+        return _reply(69, str(e).encode())
+    spawned = perf_counter()
+
+    # stderr is read meanwhile, so the mailer never blocks writing it
+    stderr = []
+    reader = threading.Thread(
+        target=lambda: stderr.append(process.stderr.read()), daemon=True)
+    reader.start()
+    try:
+        _copy(conn, process.stdin)
+    except BaseException:
+        # the message was cut short; the mailer must not queue it
+        process.kill()
+        raise
+    finally:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        process.wait()
+        reader.join()
+        process.stderr.close()
+    return _reply(process.returncode, stderr[0], spawned - start,
+                  perf_counter() - spawned)
+
+
+def _copy(conn, fp):
+    # writes the chunks of a message read from conn to fp, until the empty
+    # chunk ending it; what the mailer no longer reads is thrown away
+    while True:
+        size, = CHUNK.unpack(_read(conn, CHUNK.size))
+        if not size:
+            return
+        data = _read(conn, size)
+        if fp is not None:
+            try:
+                fp.write(data)
+            except OSError:
+                # the mailer gave up early; its return code tells us why
+                fp = None
+
+
+def _reply(returncode, stderr, spawn=0.0, wait=0.0):
+    return {'returncode': returncode, 'stderr': stderr.decode('latin-1'),
+            'spawn': spawn, 'wait': wait}
+
+
+def _watch(stdin):
+    # the process that started us holds the other end of stdin; once it
+    # and its children are gone, so are we
+    stdin.read()
+    os._exit(0)
+
+
+def serve(path, mailer):
+    """
+    Runs the helper, serving requests on the unix socket at path.
+
+    :param path: path of the socket
+    :param mailer: path of the mailer, the only program run
+    """
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # the socket is created 0600, whatever directory it is placed in
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(128)
+
+    threading.Thread(target=_watch, args=(sys.stdin.buffer,),
+                     daemon=True).start()
+    sys.stdout.buffer.write(b'ready\n')
+    sys.stdout.buffer.flush()
+
+    while True:
+        conn, address = server.accept()
+        threading.Thread(target=_handle, args=(conn, mailer),
+                         daemon=True).start()
+
+
+if __name__ == '__main__':
+    serve(sys.argv[1], sys.argv[2])
@@ -38,6 +38,9 @@ setup(
     install_requires=[
         'Flask',
     ],
+    extras_require={
+        'dkim': ['cryptography'],
+    },
     tests_require=[
         'nose',
     ],